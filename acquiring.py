@@ -1,22 +1,39 @@
 import asyncio
 import json
+import logging
 import os
 import time
 import uuid
 
-import aiohttp
 from dotenv import load_dotenv
 
+from admission import admit
+from logs import LOG_SAMPLE_RATE
+from metrics import observe_upstream
+from resilience import client_session, guard
+
 load_dotenv()
 
 USER = os.getenv('BANK_USER')
 PASSWORD = os.getenv('BANK_PASS')
+BANK_URL = os.getenv('BANK_URL', 'https://pay.alfabank.ru/payment/rest')
+
+logger = logging.getLogger('acquiring')
+
+
+def _log_response(method: str, params: dict, status: int, body: str) -> None:
+    # Credentials in params are redacted by the log writer; successful calls are sampled
+    if status >= 400:
+        logger.warning('alfa %s failed', method, extra={'status': status, 'params': params, 'body': body})
+    else:
+        logger.info('alfa %s', method, extra={'status': status, 'params': params, 'body': body,
+                                              'sample_rate': LOG_SAMPLE_RATE})
 
 
 async def pay_request(amount_rubles, auto_payment=False, client_id=None):
     order_number = str(uuid.uuid4())
     amount_kopecks = amount_rubles * 100
-    url = 'https://pay.alfabank.ru/payment/rest/register.do'
+    url = f'{BANK_URL}/register.do'
     params = {
         'userName': USER,
         'password': PASSWORD,
@@ -33,14 +50,16 @@ async def pay_request(amount_rubles, auto_payment=False, client_id=None):
 
     headers = {'accept': '*/*'}
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, params=params, headers=headers) as response:
-            print(await response.text())
-            return json.loads(await response.text())
+    async with client_session('alfa') as session:
+        async with guard('alfa'), admit('alfa'), observe_upstream('alfa', 'register.do'):
+            async with session.post(url, params=params, headers=headers) as response:
+                text = await response.text()
+                _log_response('register.do', params, response.status, text)
+                return json.loads(text)
 
 
 async def autopay_request(order_id, binding_id, client_ip):
-    url = 'https://pay.alfabank.ru/payment/rest/paymentOrderBinding.do'
+    url = f'{BANK_URL}/paymentOrderBinding.do'
     params = {
         'userName': USER,
         'password': PASSWORD,
@@ -51,15 +70,16 @@ async def autopay_request(order_id, binding_id, client_ip):
     }
     headers = {'accept': '*/*'}
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, params=params, headers=headers) as response:
-            print(response.url)
-            print(await response.text())
-            return await response.text()
+    async with client_session('alfa') as session:
+        async with guard('alfa'), admit('alfa'), observe_upstream('alfa', 'paymentOrderBinding.do'):
+            async with session.post(url, params=params, headers=headers) as response:
+                text = await response.text()
+                _log_response('paymentOrderBinding.do', params, response.status, text)
+                return text
 
 
 async def get_status_payment(order_id):
-    url = 'https://pay.alfabank.ru/payment/rest/getOrderStatus.do'
+    url = f'{BANK_URL}/getOrderStatus.do'
     params = {
         'userName': USER,
         'password': PASSWORD,
@@ -67,15 +87,16 @@ async def get_status_payment(order_id):
     }
     headers = {'accept': '*/*'}
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, params=params, headers=headers) as response:
-            # print(response.url)
-            # print(await response.text())
-            return await response.text()
+    async with client_session('alfa') as session:
+        async with guard('alfa'), admit('alfa'), observe_upstream('alfa', 'getOrderStatus.do'):
+            async with session.post(url, params=params, headers=headers) as response:
+                # print(response.url)
+                # print(await response.text())
+                return await response.text()
 
 
 async def get_bindings(client_id):
-    url = 'https://pay.alfabank.ru/payment/rest/getBindings.do'
+    url = f'{BANK_URL}/getBindings.do'
     params = {
         'userName': USER,
         'password': PASSWORD,
@@ -83,14 +104,15 @@ async def get_bindings(client_id):
     }
     headers = {'accept': '*/*'}
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, params=params, headers=headers) as response:
-            result = await response.text()
-            return json.loads(result)
+    async with client_session('alfa') as session:
+        async with guard('alfa'), admit('alfa'), observe_upstream('alfa', 'getBindings.do'):
+            async with session.post(url, params=params, headers=headers) as response:
+                result = await response.text()
+                return json.loads(result)
 
 
 async def delete_binding(session, binding_id):
-    url = 'https://pay.alfabank.ru/payment/rest/unBindCard.do'
+    url = f'{BANK_URL}/unBindCard.do'
     params = {
         'userName': USER,
         'password': PASSWORD,
@@ -98,14 +120,15 @@ async def delete_binding(session, binding_id):
     }
     headers = {'accept': '*/*'}
 
-    async with session.post(url, params=params, headers=headers) as response:
-        print(await response.text())
+    async with guard('alfa'), admit('alfa'), observe_upstream('alfa', 'unBindCard.do'):
+        async with session.post(url, params=params, headers=headers) as response:
+            _log_response('unBindCard.do', params, response.status, await response.text())
 
 
 async def delete_bindings(client_id):
     bindings = await get_bindings(client_id)
     binding_ids = bindings['bindings']
 
-    async with aiohttp.ClientSession() as session:
+    async with client_session('alfa') as session:
         tasks = [delete_binding(session, binding_id['bindingId']) for binding_id in binding_ids]
         await asyncio.gather(*tasks)
@@ -0,0 +1,113 @@
+import asyncio
+import contextvars
+import os
+from contextlib import asynccontextmanager
+from functools import wraps
+
+from metrics import DEPENDENCY_ACTIVE, DEPENDENCY_QUEUE, DEPENDENCY_SHED
+
+RETRY_AFTER = int(os.getenv('retry_after_seconds', '2'))
+
+# (concurrent calls, callers allowed to wait) per dependency; override with limit_<name> / queue_<name>
+DEFAULT_LIMITS = {
+    'app': (20, 200),
+    'BGBilling': (10, 100),
+    'Felix': (10, 100),
+    'alfa': (10, 50),
+    'onesignal': (20, 100000),
+    'zabbix': (5, 100),
+    'billing-2': (10, 100),
+}
+
+# Seconds a caller may wait for a slot; override with queue_wait_<name>, default queue_wait_seconds. Pushes
+# are sent in bulk by the worker's jobs, so their queue drains at OneSignal's pace rather than within a request.
+DEFAULT_QUEUE_WAITS = {
+    'onesignal': 1800,
+}
+QUEUE_WAIT = float(os.getenv('queue_wait_seconds', '10'))
+
+# Dependencies whose slot the current task already holds, so nested helpers don't queue twice
+_held = contextvars.ContextVar('held_dependencies', default=frozenset())
+
+
+class Overloaded(Exception):
+    def __init__(self, dependency: str):
+        super().__init__(f'{dependency} is overloaded')
+        self.dependency = dependency
+
+
+class Limiter:
+    def __init__(self, name: str, limit: int, queue: int, wait_timeout: float):
+        self.name = name
+        self.limit = limit
+        self.queue = queue
+        self.wait_timeout = wait_timeout
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(limit)
+        self._queue_gauge = DEPENDENCY_QUEUE.labels(name)
+        self._active_gauge = DEPENDENCY_ACTIVE.labels(name)
+        self._shed = DEPENDENCY_SHED.labels(name)
+
+    async def _acquire(self):
+        if self._semaphore.locked():
+            if self.waiting >= self.queue:
+                self._shed.inc()
+                raise Overloaded(self.name)
+            self.waiting += 1
+            self._queue_gauge.inc()
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), self.wait_timeout)
+            except asyncio.TimeoutError:
+                self._shed.inc()
+                raise Overloaded(self.name)
+            finally:
+                self.waiting -= 1
+                self._queue_gauge.dec()
+        else:
+            await self._semaphore.acquire()
+
+    @asynccontextmanager
+    async def slot(self):
+        held = _held.get()
+        if self.name in held:
+            yield
+            return
+        await self._acquire()
+        self._active_gauge.inc()
+        token = _held.set(held | {self.name})
+        try:
+            yield
+        finally:
+            _held.reset(token)
+            self._active_gauge.dec()
+            self._semaphore.release()
+
+
+def _limiter(name: str, limit: int, queue: int) -> Limiter:
+    key = name.lower().replace('-', '_')
+    return Limiter(name,
+                   int(os.getenv(f'limit_{key}', limit)),
+                   int(os.getenv(f'queue_{key}', queue)),
+                   float(os.getenv(f'queue_wait_{key}', DEFAULT_QUEUE_WAITS.get(name, QUEUE_WAIT))))
+
+
+limiters = {name: _limiter(name, limit, queue) for name, (limit, queue) in DEFAULT_LIMITS.items()}
+
+
+def admit(dependency: str):
+    return limiters[dependency].slot()
+
+
+def limited(dependency: str):
+    # Decorator for db helpers: run inside a slot of the dependency's limiter
+    limiter = limiters[dependency]
+
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            async with limiter.slot():
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
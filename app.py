@@ -1,23 +1,44 @@
-import datetime
+import asyncio
+import logging
+import os
 from typing import Optional
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from fastapi import FastAPI, HTTPException, Depends, status, BackgroundTasks, Query
+from fastapi import FastAPI, HTTPException, Depends, status, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 
 from acquiring import pay_request, delete_bindings
-from db.app_db import init_db, store_refresh_token, add_user, is_refresh_token_valid, get_autopay, delete_autopay, \
-    get_accident_status, add_message, get_messages, get_rooms, get_group_news, get_requisites_json
+from admission import Overloaded, RETRY_AFTER
+from conditional import make_etag, is_not_modified, not_modified, set_etag
+from logs import request_id_middleware, setup_logging
+from metrics import metrics_middleware, render_metrics
+from resilience import CircuitOpen, DeadlineExceeded, deadline_middleware
+from db.app_db import store_refresh_token, add_user, is_refresh_token_valid, get_autopay, delete_autopay, \
+    get_accident_status, add_message, get_messages, get_rooms, get_group_news, get_requisites_json, \
+    load_accident_status, load_requisites, add_payment_order, search_messages, mark_room_read, \
+    storage, sync_news_cache, NEWS_SYNC_INTERVAL
 from db.billing_db import get_user_data, get_payments, update_password
+from db.migrations import migrate
+from db.query_stats import top_queries
 from schemas import User, Token, RefreshTokenRequest, UserData, HistoryPaymentsList, PasswordUpdate, News, Payment, \
-    PaymentAmount, AutoPayDetails, Accident, MessagesList, Message, Rooms, SupportMessage, Company
+    PaymentAmount, AutoPayDetails, Accident, MessagesList, Message, Rooms, SupportMessage, Company, SearchResults, \
+    Bootstrap
 from service import authenticate_user, create_access_token, create_refresh_token, decode_token, get_current_user, \
     validate_password, is_support
-from tasks import check_payment_status, init_autopay, check_news_alerts, pay_day_push
 
 app = FastAPI(title='VostokTelekom Mobile API', description='BASE URL >> https://mobile.vt54.ru')
 scheduler = AsyncIOScheduler()
+# Run the background worker's jobs inside the API process (single-process/dev deployments)
+EMBEDDED_WORKER = os.getenv('embedded_worker', '0') == '1'
+BOOTSTRAP_SECTION_TIMEOUT = float(os.getenv('bootstrap_section_seconds', '3'))
 
+logger = logging.getLogger('app')
+setup_logging()
+
+app.middleware("http")(deadline_middleware)
+app.middleware("http")(metrics_middleware)
+app.middleware("http")(request_id_middleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -27,6 +48,26 @@ app.add_middleware(
 )
 
 
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    return ORJSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                          content={"detail": f"Service temporarily overloaded ({exc.dependency})"},
+                          headers={"Retry-After": str(RETRY_AFTER)})
+
+
+@app.exception_handler(CircuitOpen)
+async def circuit_open_handler(request: Request, exc: CircuitOpen):
+    return ORJSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                          content={"detail": f"Service temporarily unavailable ({exc.dependency})"},
+                          headers={"Retry-After": str(exc.retry_after)})
+
+
+@app.exception_handler(DeadlineExceeded)
+async def deadline_exceeded_handler(request: Request, exc: DeadlineExceeded):
+    return ORJSONResponse(status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                          content={"detail": f"Upstream did not answer in time ({exc.dependency})"})
+
+
 # Define the authentication route
 @app.post("/api/auth", response_model=Token, responses={401: {"description": "Incorrect username or password"}},
           tags=['auth'])
@@ -68,10 +109,15 @@ async def refresh_token(request: RefreshTokenRequest):
 
 
 # Define the /api/me endpoint
-@app.get("/api/me", response_model=UserData, responses={401: {"description": "Invalid access token"}},
+@app.get("/api/me", response_model=UserData,
+         responses={304: {"description": "Not modified"}, 401: {"description": "Invalid access token"}},
          tags=['user'])
-async def read_current_user(current_user: str = Depends(get_current_user)):
+async def read_current_user(request: Request, response: Response, current_user: str = Depends(get_current_user)):
     user_data = await get_user_data(current_user)
+    etag = make_etag('me', current_user, user_data)
+    if is_not_modified(request, etag):
+        return not_modified(etag)
+    set_etag(response, etag)
     return user_data
 
 
@@ -83,41 +129,56 @@ async def set_new_password(password: PasswordUpdate = Depends(validate_password)
 
 
 @app.get("/api/collection-payments", response_model=HistoryPaymentsList,
-         responses={401: {"description": "Invalid access token"}}, tags=['collection'])
-async def get_payments_history(current_user: str = Depends(get_current_user)):
+         responses={304: {"description": "Not modified"}, 401: {"description": "Invalid access token"}},
+         tags=['collection'])
+async def get_payments_history(request: Request, current_user: str = Depends(get_current_user)):
     payments_history = await get_payments(current_user)
-    return {'payments': payments_history}
+    etag = make_etag('payments', current_user, [payment['id'] for payment in payments_history])
+    if is_not_modified(request, etag):
+        return not_modified(etag)
+    response = ORJSONResponse({'payments': payments_history})
+    set_etag(response, etag)
+    return response
 
 
 @app.get("/api/collection-news", response_model=News,
-         responses={401: {"description": "Invalid access token"}}, tags=['collection'])
-async def get_news(current_user: str = Depends(get_current_user)):
+         responses={304: {"description": "Not modified"}, 401: {"description": "Invalid access token"}},
+         tags=['collection'])
+async def get_news(request: Request, current_user: str = Depends(get_current_user)):
     news = await get_group_news(current_user)
-    return news
+    etag = make_etag('news', [item['article'] for item in news['news']])
+    if is_not_modified(request, etag):
+        return not_modified(etag)
+    response = ORJSONResponse(news)
+    set_etag(response, etag)
+    return response
 
 
 @app.post("/api/pay", response_model=Payment,
           responses={401: {"description": "Invalid access token"}}, tags=['payments'])
-async def process_payment(request: PaymentAmount,
-                          background_tasks: BackgroundTasks, current_user: str = Depends(get_current_user)):
+async def process_payment(request: PaymentAmount, current_user: str = Depends(get_current_user)):
     response = await pay_request(request.amount_roubles, client_id=current_user)
-    background_tasks.add_task(check_payment_status, response['orderId'], current_user, autopay=False)
+    await add_payment_order(response['orderId'], current_user, autopay=False)
     return response
 
 
 @app.get("/api/autopay", response_model=AutoPayDetails,
-         responses={401: {"description": "Invalid access token"}}, tags=['payments'])
-async def get_autopay_data(current_user: str = Depends(get_current_user)):
+         responses={304: {"description": "Not modified"}, 401: {"description": "Invalid access token"}},
+         tags=['payments'])
+async def get_autopay_data(request: Request, response: Response, current_user: str = Depends(get_current_user)):
     data = await get_autopay(current_user)
+    etag = make_etag('autopay', current_user, data)
+    if is_not_modified(request, etag):
+        return not_modified(etag)
+    set_etag(response, etag)
     return data
 
 
 @app.post("/api/autopay", response_model=Payment,
           responses={401: {"description": "Invalid access token"}}, tags=['payments'])
-async def enable_autopay(request: PaymentAmount,
-                         background_tasks: BackgroundTasks, current_user: str = Depends(get_current_user)):
+async def enable_autopay(request: PaymentAmount, current_user: str = Depends(get_current_user)):
     response = await pay_request(request.amount_roubles, auto_payment=True, client_id=current_user)
-    background_tasks.add_task(check_payment_status, response['orderId'], current_user, autopay=True)
+    await add_payment_order(response['orderId'], current_user, autopay=True)
     return response
 
 
@@ -137,6 +198,53 @@ async def get_accident(current_user: str = Depends(get_current_user)):
     return {"accident": alert_status}
 
 
+def _section_error(error: BaseException) -> str:
+    if isinstance(error, CircuitOpen):
+        return 'unavailable'
+    if isinstance(error, (DeadlineExceeded, asyncio.TimeoutError)):
+        return 'timeout'
+    if isinstance(error, Overloaded):
+        return 'overloaded'
+    if isinstance(error, LookupError):
+        return 'not_found'
+    logger.error('bootstrap section failed: %r', error)
+    return 'error'
+
+
+async def _bootstrap_me(account: str) -> dict:
+    # get_user_data returns None for an unknown contract and the UserData class itself for an unsupported account
+    user_data = await get_user_data(account)
+    if not isinstance(user_data, UserData):
+        raise LookupError(f'no user data for {account}')
+    return user_data.model_dump()
+
+
+@app.get("/api/bootstrap", response_model=Bootstrap,
+         responses={401: {"description": "Invalid access token"}}, tags=['user'])
+async def bootstrap(current_user: str = Depends(get_current_user)):
+    # /api/me, /api/autopay, /api/accident, /api/collection-news and the first /api/chat page in one round trip.
+    # Sections run concurrently, each within BOOTSTRAP_SECTION_TIMEOUT, and fail independently.
+    sections = {
+        'me': _bootstrap_me(current_user),
+        'autopay': get_autopay(current_user),
+        'accident': get_accident_status(current_user),
+        'news': get_group_news(current_user),
+        'chat': get_messages(room_id=current_user),
+    }
+    results = await asyncio.gather(*[asyncio.wait_for(section, BOOTSTRAP_SECTION_TIMEOUT)
+                                     for section in sections.values()], return_exceptions=True)
+    body = {'errors': {}}
+    for name, result in zip(sections, results):
+        if isinstance(result, BaseException):
+            body[name] = None
+            body['errors'][name] = _section_error(result)
+        elif name == 'accident':
+            body[name] = {'accident': result}
+        else:
+            body[name] = result
+    return ORJSONResponse(body)
+
+
 @app.get("/api/chat", response_model=MessagesList,
          responses={401: {"description": "Invalid access token"}, 500: {"description": "Internal server error"}},
          tags=['chat'])
@@ -146,7 +254,7 @@ async def get_chat_messages(current_user: str = Depends(get_current_user),
                             less_id: Optional[int] = Query(None,
                                                            description='filters results less than id (optional)')):
     messages = await get_messages(room_id=current_user, greater_id=greater_id, less_id=less_id)
-    return messages
+    return ORJSONResponse(messages)
 
 
 @app.post("/api/chat", response_model=MessagesList,
@@ -156,17 +264,36 @@ async def post_new_user_message(message: Message, current_user: str = Depends(ge
     if message.message:
         await add_message(current_user, message.role, message.message, message.type)
     messages = await get_messages(room_id=current_user, greater_id=message.id)
-    return messages
+    return ORJSONResponse(messages)
 
 
 @app.get('/api/rooms', response_model=Rooms,
          responses={401: {"description": "Invalid access token"}, 500: {"description": "Internal server error"}},
          tags=['rooms'])
-async def get_chat_rooms(current_user: str = Depends(get_current_user)):
+async def get_chat_rooms(less_id: Optional[int] = Query(None, description='next_less_id of the previous page'),
+                         limit: int = Query(50, ge=1, le=200, description='page size'),
+                         awaiting_reply: bool = Query(False, description='only rooms waiting for an operator'),
+                         requires_action: bool = Query(False, description='only rooms whose request needs action'),
+                         accident: bool = Query(False, description='only rooms of subscribers in an accident'),
+                         current_user: str = Depends(get_current_user)):
+    if not await is_support(current_user):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect admin credentials")
+    rooms = await get_rooms(less_id=less_id, limit=limit, awaiting_reply=awaiting_reply,
+                            requires_action=requires_action, accident=accident)
+    return ORJSONResponse(rooms)
+
+
+@app.get('/api/rooms/search', response_model=SearchResults,
+         responses={401: {"description": "Invalid access token"}, 500: {"description": "Internal server error"}},
+         tags=['rooms'])
+async def search_rooms(q: str = Query(..., min_length=3, max_length=200, description='words to search for'),
+                       less_id: Optional[int] = Query(None, description='next_less_id of the previous page (optional)'),
+                       limit: int = Query(50, ge=1, le=200, description='page size'),
+                       current_user: str = Depends(get_current_user)):
     if not await is_support(current_user):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect admin credentials")
-    rooms = await get_rooms()
-    return rooms
+    results = await search_messages(q, less_id=less_id, limit=limit)
+    return ORJSONResponse(results)
 
 
 @app.get('/api/rooms/chat', response_model=MessagesList,
@@ -180,8 +307,9 @@ async def get_rooms_messages(room_id: Optional[str] = Query(None, description='r
                              current_user: str = Depends(get_current_user)):
     if not await is_support(current_user):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect admin credentials")
+    await mark_room_read(room_id)
     messages = await get_messages(room_id=room_id, greater_id=greater_id, less_id=less_id)
-    return messages
+    return ORJSONResponse(messages)
 
 
 @app.post('/api/rooms/chat', response_model=MessagesList,
@@ -194,28 +322,59 @@ async def post_new_admin_message(message: SupportMessage,
     if message.message:
         await add_message(message.room_id, message.role, message.message)
     messages = await get_messages(room_id=message.room_id, greater_id=message.id)
-    return messages
+    return ORJSONResponse(messages)
 
 
 @app.get("/api/requisites", response_model=Company,
-         responses={401: {"description": "Invalid access token"}, 500: {"description": "Internal server error"}},
+         responses={304: {"description": "Not modified"}, 401: {"description": "Invalid access token"},
+                    500: {"description": "Internal server error"}},
          tags=['requisites'])
-async def requisites(current_user: str = Depends(get_current_user)):
-    company_data = await get_requisites_json()
-    return Company(**company_data)
+async def requisites(request: Request, current_user: str = Depends(get_current_user)):
+    body, etag = get_requisites_json()
+    if is_not_modified(request, etag):
+        return not_modified(etag)
+    response = Response(content=body, media_type='application/json')
+    set_etag(response, etag)
+    return response
+
+
+@app.get('/api/admin/queries',
+         responses={401: {"description": "Invalid access token"}, 500: {"description": "Internal server error"}},
+         tags=['admin'])
+async def get_query_stats(limit: int = Query(20, ge=1, le=500, description='number of fingerprints'),
+                          order_by: str = Query('total_ms', pattern='^(total_ms|max_ms|count|rows|slow)$',
+                                                description='sort key'),
+                          current_user: str = Depends(get_current_user)):
+    if not await is_support(current_user):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect admin credentials")
+    return ORJSONResponse({'queries': top_queries(limit, order_by)})
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return render_metrics()
 
 
 @app.on_event("startup")
 async def startup_event():
-    await init_db()
+    await migrate()
+    await load_accident_status()
+    load_requisites()
     scheduler.start()
-    scheduler.add_job(pay_day_push, trigger='cron', hour=10, minute=0, max_instances=1)
-    scheduler.add_job(check_news_alerts, trigger='interval', minutes=5, max_instances=1)
-    scheduler.add_job(init_autopay, trigger='interval', days=1, max_instances=1,
-                      next_run_time=datetime.datetime.now() + datetime.timedelta(seconds=60))
+    # check_alerts runs in the background worker, so accident changes are picked up from the alerts table
+    scheduler.add_job(load_accident_status, trigger='interval', minutes=1, max_instances=1)
+    # News changes made by the worker's jobs reach this process's news cache through sync_news_cache
+    scheduler.add_job(sync_news_cache, trigger='interval', seconds=NEWS_SYNC_INTERVAL, max_instances=1)
+    if EMBEDDED_WORKER:
+        import worker
+        await worker.start(scheduler)
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
     scheduler.remove_all_jobs()
     scheduler.shutdown()
+    if EMBEDDED_WORKER:
+        import worker
+        await worker.stop()
+    await storage.close()
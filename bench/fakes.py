@@ -0,0 +1,100 @@
+# In-process stand-ins for the upstream HTTP services used by the API and the scheduler:
+# Alfa-Bank REST (register/getOrderStatus/paymentOrderBinding/getBindings/unBindCard),
+# OneSignal notifications, Zabbix JSON-RPC and the billing-2 top-up hook.
+import asyncio
+import json
+import uuid
+
+from aiohttp import web
+
+
+class Upstreams:
+    def __init__(self, latency: float = 0.0, host: str = '127.0.0.1'):
+        self.latency = latency
+        self.host = host
+        self.port = None
+        self.calls = {}
+        self._runner = None
+
+    @property
+    def base_url(self) -> str:
+        return f'http://{self.host}:{self.port}'
+
+    def env(self) -> dict:
+        # Environment overrides that point the app at these fakes
+        return {
+            'BANK_URL': f'{self.base_url}/payment/rest',
+            'push_api_url': f'{self.base_url}/api/v1/notifications',
+            'zabbix_api_url': f'{self.base_url}/zabbix/api_jsonrpc.php',
+            'billing2_pay_url': f'{self.base_url}/alfa-pay/1',
+        }
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/payment/rest/register.do', self.register)
+        app.router.add_post('/payment/rest/getOrderStatus.do', self.order_status)
+        app.router.add_post('/payment/rest/paymentOrderBinding.do', self.order_binding)
+        app.router.add_post('/payment/rest/getBindings.do', self.bindings)
+        app.router.add_post('/payment/rest/unBindCard.do', self.unbind_card)
+        app.router.add_post('/api/v1/notifications', self.notification)
+        app.router.add_route('*', '/zabbix/api_jsonrpc.php', self.zabbix)
+        app.router.add_get('/alfa-pay/1', self.billing2_pay)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _respond(self, name: str, payload) -> web.Response:
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if isinstance(payload, str):
+            return web.Response(text=payload)
+        return web.Response(text=json.dumps(payload), content_type='application/json')
+
+    async def register(self, request: web.Request):
+        order_id = str(uuid.uuid4())
+        return await self._respond('register.do', {'orderId': order_id,
+                                                   'formUrl': f'{self.base_url}/payment/merchants/{order_id}'})
+
+    async def order_status(self, request: web.Request):
+        return await self._respond('getOrderStatus.do', {'OrderStatus': 2, 'Amount': 50000,
+                                                         'bindingId': str(uuid.uuid4()), 'Ip': '127.0.0.1'})
+
+    async def order_binding(self, request: web.Request):
+        return await self._respond('paymentOrderBinding.do', {'errorCode': 0})
+
+    async def bindings(self, request: web.Request):
+        return await self._respond('getBindings.do', {'bindings': [{'bindingId': str(uuid.uuid4())}]})
+
+    async def unbind_card(self, request: web.Request):
+        return await self._respond('unBindCard.do', {'errorCode': '0'})
+
+    async def notification(self, request: web.Request):
+        await request.read()
+        return await self._respond('onesignal', {'id': str(uuid.uuid4()), 'recipients': 1})
+
+    async def zabbix(self, request: web.Request):
+        body = await request.json()
+        method = body.get('method')
+        match method:
+            case 'hostgroup.get':
+                names = body['params']['filter']['name']
+                result = [{'groupid': str(i), 'name': name} for i, name in enumerate(names, start=1)]
+            case 'host.get':
+                result = [{'hostid': str(group_id), 'name': f'sw-{group_id}', 'status': '0',
+                           'hostgroups': [{'groupid': str(group_id), 'name': f'group-{group_id}'}]}
+                          for group_id in body['params']['groupids']]
+            case 'hostinterface.get':
+                result = [{'hostid': host_id, 'available': '1'} for host_id in body['params']['hostids']]
+            case _:
+                result = []
+        return await self._respond(f'zabbix {method}', {'jsonrpc': '2.0', 'result': result, 'id': body.get('id')})
+
+    async def billing2_pay(self, request: web.Request):
+        return await self._respond('billing-2 pay', 'OK')
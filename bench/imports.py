@@ -0,0 +1,65 @@
+# Import-time check: what a fresh API process pays before it can serve a request.
+#
+# Runs `python -X importtime -c "import <module>"` in a clean interpreter, prints the slowest modules by
+# cumulative time and exits non-zero when the total is over budget or a module that must stay lazy (the
+# integration clients only the worker's jobs use) was imported.
+#
+#   python -m bench.imports [--module app] [--budget-ms 800] [--top 15]
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+# Per entry point, modules loaded on first use (resilience.client_session, tasks.check_news) that importing
+# it must not pull in
+LAZY_MODULES = {
+    'app': ('aiohttp', 'gspread', 'oauth2client', 'tasks'),
+    'worker': ('aiohttp', 'gspread', 'oauth2client'),
+}
+
+# Module-level config the app reads at import time; any value does, nothing connects
+IMPORT_ENV = {'app_db_port': '3306', 'billing_db_port': '3306'}
+
+_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def import_times(module: str) -> list:
+    env = {**IMPORT_ENV, **os.environ}
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, env=env,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    if result.returncode != 0:
+        sys.exit(f'import {module} failed:\n{result.stderr[-2000:]}')
+    # (self us, cumulative us, depth, name)
+    return [(int(own), int(cumulative), len(indent) // 2, name)
+            for own, cumulative, indent, name in _LINE.findall(result.stderr)]
+
+
+def main(module: str, budget_ms: float, top: int) -> int:
+    times = import_times(module)
+    total_ms = next(cumulative for _, cumulative, _, name in reversed(times) if name == module) / 1000
+    print(f'{"module":<50}{"self ms":>10}{"cumulative ms":>15}')
+    for own, cumulative, _, name in sorted(times, key=lambda row: row[1], reverse=True)[:top]:
+        print(f'{name:<50}{own / 1000:>10.1f}{cumulative / 1000:>15.1f}')
+
+    failures = []
+    imported = {name for _, _, _, name in times}
+    eager = [name for name in LAZY_MODULES.get(module, ()) if name in imported]
+    if eager:
+        failures.append(f'imported eagerly: {", ".join(eager)}')
+    if total_ms > budget_ms:
+        failures.append(f'import {module} took {total_ms:.0f} ms, budget {budget_ms:.0f} ms')
+    print(f'\nimport {module}: {total_ms:.0f} ms (budget {budget_ms:.0f} ms)')
+    for failure in failures:
+        print(f'FAIL {failure}')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--module', default='app')
+    parser.add_argument('--budget-ms', type=float, default=800)
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+    sys.exit(main(args.module, args.budget_ms, args.top))
@@ -0,0 +1,218 @@
+# Reproducible endpoint load test. Seeds local MySQL databases, starts the upstream fakes in-process,
+# runs `uvicorn app:app` against both and drives one of the request mixes, then reports RPS and
+# p50/p95/p99 latency per route.
+#
+#   bench_mysql_host=127.0.0.1 bench_mysql_user=root bench_mysql_pass=... \
+#       python -m bench.load --mix mixed --duration 30 --concurrency 50
+import argparse
+import asyncio
+import math
+import os
+import random
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+from bench.fakes import Upstreams
+from bench.seed import seed, app_env
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    def add(self, route: str, elapsed: float, ok: bool):
+        self.latencies.setdefault(route, []).append(elapsed)
+        if not ok:
+            self.errors[route] = self.errors.get(route, 0) + 1
+
+    def report(self, duration: float) -> str:
+        lines = [f'{"route":<34}{"count":>8}{"errors":>8}{"rps":>9}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}']
+        total = 0
+        for route, samples in sorted(self.latencies.items()):
+            samples.sort()
+            total += len(samples)
+            lines.append(f'{route:<34}{len(samples):>8}{self.errors.get(route, 0):>8}'
+                         f'{len(samples) / duration:>9.1f}{percentile(samples, 50):>9.1f}'
+                         f'{percentile(samples, 95):>9.1f}{percentile(samples, 99):>9.1f}')
+        lines.append(f'{"total":<34}{total:>8}{sum(self.errors.values()):>8}{total / duration:>9.1f}')
+        return '\n'.join(lines)
+
+
+def percentile(ordered: list, pct: float) -> float:
+    if not ordered:
+        return 0.0
+    index = max(0, math.ceil(pct / 100 * len(ordered)) - 1)
+    return ordered[index] * 1000
+
+
+class Client:
+    def __init__(self, session: aiohttp.ClientSession, base_url: str, stats: Stats):
+        self.session = session
+        self.base_url = base_url
+        self.stats = stats
+
+    async def call(self, method: str, route: str, path: str = None, token: str = None, **kwargs):
+        headers = {'Authorization': f'Bearer {token}'} if token else {}
+        start = time.perf_counter()
+        try:
+            async with self.session.request(method, self.base_url + (path or route), headers=headers,
+                                            **kwargs) as response:
+                body = await response.read()
+                ok = response.status < 400
+        except aiohttp.ClientError:
+            body, ok = b'', False
+        self.stats.add(f'{method} {route}', time.perf_counter() - start, ok)
+        return body if ok else None
+
+
+# Request mixes. Each scenario is one user session; routes are reported by template.
+async def app_launch(client: Client, user: dict, support: dict, rng: random.Random):
+    for route in ('/api/me', '/api/autopay', '/api/accident', '/api/collection-news', '/api/chat'):
+        await client.call('GET', route, token=user['token'])
+
+
+async def app_launch_bootstrap(client: Client, user: dict, support: dict, rng: random.Random):
+    await client.call('GET', '/api/bootstrap', token=user['token'])
+
+
+async def chat_polling(client: Client, user: dict, support: dict, rng: random.Random):
+    await client.call('GET', '/api/chat', token=user['token'])
+    for _ in range(5):
+        if rng.random() < 0.2:
+            await client.call('POST', '/api/chat', token=user['token'],
+                              json={'message': 'Не работает интернет', 'type': rng.choice(['support', 'noInternet'])})
+        else:
+            await client.call('GET', '/api/chat', '/api/chat?greater_id=0', token=user['token'])
+        await asyncio.sleep(0.05)
+
+
+async def payment_flow(client: Client, user: dict, support: dict, rng: random.Random):
+    await client.call('GET', '/api/me', token=user['token'])
+    await client.call('POST', '/api/pay', token=user['token'], json={'amount_roubles': rng.choice([500, 1000])})
+    await client.call('GET', '/api/collection-payments', token=user['token'])
+    await client.call('GET', '/api/autopay', token=user['token'])
+
+
+async def operator_dashboard(client: Client, user: dict, support: dict, rng: random.Random):
+    await client.call('GET', '/api/rooms', token=support['token'])
+    await client.call('GET', '/api/rooms', '/api/rooms?awaiting_reply=true', token=support['token'])
+    room_id = user['account']
+    await client.call('GET', '/api/rooms/chat', f'/api/rooms/chat?room_id={room_id}', token=support['token'])
+    await client.call('GET', '/api/rooms/chat', f'/api/rooms/chat?room_id={room_id}&less_id=1000000',
+                      token=support['token'])
+    await client.call('POST', '/api/rooms/chat', token=support['token'],
+                      json={'room_id': user['account'], 'message': 'Проверяем линию'})
+
+
+MIXES = {
+    'app-launch': {app_launch: 1},
+    'app-launch-bootstrap': {app_launch_bootstrap: 1},
+    'chat-polling': {chat_polling: 1},
+    'payment-flow': {payment_flow: 1},
+    'operator-dashboard': {operator_dashboard: 1},
+    'mixed': {app_launch: 10, chat_polling: 5, payment_flow: 1, operator_dashboard: 1},
+}
+
+
+async def wait_ready(session: aiohttp.ClientSession, base_url: str, process: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('app process exited during startup')
+        try:
+            async with session.get(f'{base_url}/openapi.json') as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError('app did not become ready')
+
+
+async def login(session: aiohttp.ClientSession, base_url: str, account: str) -> dict:
+    async with session.post(f'{base_url}/api/auth', json={'login': account, 'password': account}) as response:
+        response.raise_for_status()
+        tokens = await response.json()
+        return {'account': account, 'token': tokens['access_token']}
+
+
+async def drive(client: Client, users: list, support: dict, mix: dict, duration: float, concurrency: int,
+                seed_value: int):
+    scenarios, weights = list(mix), list(mix.values())
+    deadline = time.monotonic() + duration
+
+    async def worker(worker_id: int):
+        rng = random.Random(seed_value + worker_id)
+        while time.monotonic() < deadline:
+            scenario = rng.choices(scenarios, weights)[0]
+            await scenario(client, rng.choice(users), support, rng)
+
+    await asyncio.gather(*[worker(i) for i in range(concurrency)])
+
+
+async def main(args):
+    upstreams = Upstreams(latency=args.upstream_latency / 1000)
+    await upstreams.start()
+    env = {
+        **app_env(),
+        **upstreams.env(),
+        'secret': 'bench-secret', 'algorithm': 'HS256',
+        'BANK_USER': 'bench', 'BANK_PASS': 'bench',
+        'push_api_key': 'bench', 'push_app_id': 'bench', 'zabbix_token': 'bench',
+    }
+    os.environ.update(env)
+    print('seeding databases ...', file=sys.stderr)
+    accounts = await seed(args.subscribers, args.rooms, args.messages_per_room, seed_value=args.seed)
+
+    base_url = f'http://127.0.0.1:{args.port}'
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'app:app', '--port', str(args.port), '--workers', str(args.workers),
+         '--no-access-log', '--log-level', 'warning'],
+        env={**os.environ, **env},
+    )
+    try:
+        connector = aiohttp.TCPConnector(limit=args.concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            await wait_ready(session, base_url, process)
+            rng = random.Random(args.seed)
+            sample = rng.sample(accounts['old'] + accounts['new'], min(args.users, args.subscribers))
+            users = await asyncio.gather(*[login(session, base_url, account) for account in sample])
+            support = await login(session, base_url, accounts['support'])
+
+            stats = Stats()
+            client = Client(session, base_url, stats)
+            print(f'driving mix {args.mix!r} for {args.duration}s with {args.concurrency} clients ...',
+                  file=sys.stderr)
+            started = time.monotonic()
+            await drive(client, users, support, MIXES[args.mix], args.duration, args.concurrency, args.seed)
+            elapsed = time.monotonic() - started
+        print(stats.report(elapsed))
+        print(f'\nupstream calls: {dict(sorted(upstreams.calls.items()))}')
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+        await upstreams.stop()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='VostokTelekom Mobile API load test')
+    parser.add_argument('--mix', choices=sorted(MIXES), default='mixed')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to drive load')
+    parser.add_argument('--concurrency', type=int, default=50, help='concurrent virtual clients')
+    parser.add_argument('--users', type=int, default=200, help='distinct logged-in subscribers')
+    parser.add_argument('--subscribers', type=int, default=2000, help='seeded subscriber accounts')
+    parser.add_argument('--rooms', type=int, default=500, help='seeded chat rooms')
+    parser.add_argument('--messages-per-room', type=int, default=50)
+    parser.add_argument('--upstream-latency', type=float, default=20, help='fake upstream latency, ms')
+    parser.add_argument('--workers', type=int, default=1, help='uvicorn workers')
+    parser.add_argument('--port', type=int, default=8054)
+    parser.add_argument('--seed', type=int, default=54)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,67 @@
+# Admission check: nested single-flight helpers under load.
+#
+# get_user_data_new calls check_support while it holds a BGBilling slot, and check_support goes through
+# @single_flight, @limited and @resilient of its own. More concurrent accounts than limit_BGBilling must all
+# be served: the nested call has to reuse its caller's slot, not queue for a second one that no caller will
+# release. Runs the repo's decorators on in-process helpers shaped like those two; exits non-zero on failure.
+#
+#   python -m bench.nested [--accounts 30] [--deadline 5]
+import argparse
+import asyncio
+import sys
+import time
+
+from admission import limited, limiters
+from metrics import observe_query
+from resilience import _deadline, breakers, resilient
+from singleflight import single_flight
+
+QUERY_SECONDS = 0.05
+
+
+@single_flight()
+@limited('BGBilling')
+@resilient('BGBilling', stale=True)
+@observe_query('BGBilling')
+async def check_support(login: str) -> bool:
+    await asyncio.sleep(QUERY_SECONDS)
+    return login.startswith('9')
+
+
+@single_flight()
+@limited('BGBilling')
+@resilient('BGBilling', stale=True)
+@observe_query('BGBilling')
+async def get_user_data_new(account: str) -> dict:
+    await asyncio.sleep(QUERY_SECONDS)
+    return {'account': account, 'support': await check_support(account)}
+
+
+async def request(account: str, deadline: float) -> dict:
+    # What deadline_middleware does for each API request
+    _deadline.set(time.monotonic() + deadline)
+    return await get_user_data_new(account)
+
+
+async def run(accounts: int, deadline: float) -> int:
+    start = time.perf_counter()
+    results = await asyncio.gather(*[request(f'{10000 + i}', deadline) for i in range(accounts)],
+                                   return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    failed = [result for result in results if isinstance(result, BaseException)]
+    state = breakers['BGBilling'].state
+    print(f'{accounts} accounts, limit_BGBilling={limiters["BGBilling"].limit}: {accounts - len(failed)} served, '
+          f'{len(failed)} failed in {elapsed:.2f}s, breaker {state}')
+    for error in failed[:5]:
+        print(f'FAIL {error!r}')
+    if state != 'closed':
+        print('FAIL BGBilling circuit opened')
+    return 1 if failed or state != 'closed' else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--accounts', type=int, default=3 * limiters['BGBilling'].limit)
+    parser.add_argument('--deadline', type=float, default=5)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args.accounts, args.deadline)))
@@ -0,0 +1,214 @@
+# Seeded local databases for the load-test suite: minimal BGBilling and Felix schemas covering the
+# columns db/billing_db.py reads, plus the app DB created by the app's own migrations.
+import os
+import random
+from datetime import datetime, timedelta
+
+import aiomysql
+
+RATES = {
+    'Минимальный-15': 3550,
+    'Стартовый-50': 4990,
+    'Оптимальный-100': 5990,
+    'Ускоренный-300': 6990,
+}
+
+BGBILLING_SCHEMA = [
+    "CREATE TABLE contract (id INT AUTO_INCREMENT PRIMARY KEY, title VARCHAR(32) UNIQUE, pswd VARCHAR(64), "
+    "comment VARCHAR(255), gr BIGINT)",
+    "CREATE TABLE contract_group (id INT PRIMARY KEY, title VARCHAR(255))",
+    "CREATE TABLE contract_payment (id INT AUTO_INCREMENT PRIMARY KEY, cid INT, summa DECIMAL(10, 2), "
+    "dt DATE, lm DATETIME, INDEX (cid, dt))",
+    "CREATE TABLE contract_parameter_type_phone (cid INT PRIMARY KEY, value VARCHAR(32))",
+    "CREATE TABLE contract_parameter_type_2 (cid INT PRIMARY KEY, address VARCHAR(255))",
+    "CREATE TABLE contract_parameter_type_3 (cid INT PRIMARY KEY, email VARCHAR(255))",
+    "CREATE TABLE tariff_plan (id INT PRIMARY KEY, title_web VARCHAR(255))",
+    "CREATE TABLE contract_tariff (id INT AUTO_INCREMENT PRIMARY KEY, cid INT, tpid INT, INDEX (cid))",
+    "CREATE TABLE contract_balance (cid INT, yy INT, mm INT, summa1 DECIMAL(10, 2), summa2 DECIMAL(10, 2), "
+    "summa3 DECIMAL(10, 2), summa4 DECIMAL(10, 2), PRIMARY KEY (cid, yy, mm))",
+]
+
+FELIX_SCHEMA = [
+    "CREATE TABLE acc_group (id INT PRIMARY KEY, name VARCHAR(255))",
+    "CREATE TABLE account (id INT AUTO_INCREMENT PRIMARY KEY, login VARCHAR(32) UNIQUE, passwd1 VARCHAR(64), "
+    "last_name VARCHAR(64), first_name VARCHAR(64), patronymic VARCHAR(64), cell_phone1 VARCHAR(32), "
+    "email VARCHAR(255), balance DECIMAL(10, 2), acc_group_id INT)",
+    "CREATE TABLE tariff (id INT PRIMARY KEY, name VARCHAR(255), price DECIMAL(10, 2))",
+    "CREATE TABLE account_service (account_id INT, tariff_id INT, INDEX (account_id))",
+    "CREATE TABLE payment (id INT AUTO_INCREMENT PRIMARY KEY, account_id INT, type INT, date_close INT, "
+    "INDEX (account_id))",
+    "CREATE TABLE deposit (id INT AUTO_INCREMENT PRIMARY KEY, account_id INT, deposit_type_id INT, "
+    "sum DECIMAL(10, 2), date_add INT, added_by INT, ext_id VARCHAR(64), comment VARCHAR(255), "
+    "INDEX (account_id, date_add))",
+]
+
+
+def server_config() -> dict:
+    return {
+        'host': os.getenv('bench_mysql_host', '127.0.0.1'),
+        'port': int(os.getenv('bench_mysql_port', '3306')),
+        'user': os.getenv('bench_mysql_user', 'root'),
+        'password': os.getenv('bench_mysql_pass', ''),
+    }
+
+
+def database_names() -> dict:
+    prefix = os.getenv('bench_db_prefix', 'vt_bench')
+    return {'app': f'{prefix}_app', 'bgbilling': f'{prefix}_bgbilling', 'felix': f'{prefix}_felix'}
+
+
+def app_env() -> dict:
+    # Environment for the app process pointing all three databases at the bench server
+    server = server_config()
+    names = database_names()
+    return {
+        'app_db_user': server['user'], 'app_db_pass': server['password'], 'app_db_name': names['app'],
+        'app_db_host': server['host'], 'app_db_port': str(server['port']),
+        'billing_db_user': server['user'], 'billing_db_pass': server['password'],
+        'billing_db_name': names['bgbilling'], 'billing_db_host': server['host'],
+        'billing_db_port': str(server['port']),
+        'old_billing_db_user': server['user'], 'old_billing_db_pass': server['password'],
+        'old_billing_db_name': names['felix'], 'old_billing_db_host': server['host'],
+    }
+
+
+def make_accounts(subscribers: int, felix_share: float = 0.2) -> dict:
+    felix_count = min(int(subscribers * felix_share), 9000)
+    return {'old': [str(1000 + i) for i in range(felix_count)],
+            'new': [str(10000 + i) for i in range(subscribers - felix_count)],
+            'support': '99999'}
+
+
+async def recreate_databases():
+    async with aiomysql.connect(**server_config(), autocommit=True) as conn:
+        async with conn.cursor() as cur:
+            for name in database_names().values():
+                await cur.execute(f"DROP DATABASE IF EXISTS `{name}`")
+                await cur.execute(f"CREATE DATABASE `{name}` CHARACTER SET utf8mb4")
+
+
+async def seed_bgbilling(accounts: list, support: str, groups: int, rng: random.Random):
+    now = datetime.now()
+    async with aiomysql.connect(**server_config(), db=database_names()['bgbilling']) as conn:
+        async with conn.cursor() as cur:
+            for statement in BGBILLING_SCHEMA:
+                await cur.execute(statement)
+            await cur.executemany("INSERT INTO contract_group (id, title) VALUES (%s, %s)",
+                                  [(group_id, f'bgbilling-abons-{group_id}') for group_id in range(1, groups + 1)])
+            await cur.executemany("INSERT INTO tariff_plan (id, title_web) VALUES (%s, %s)",
+                                  [(i, name) for i, name in enumerate(RATES, start=1)])
+            await cur.executemany(
+                "INSERT INTO contract (id, title, pswd, comment, gr) VALUES (%s, %s, %s, %s, %s)",
+                [(cid, title, title, f'Иванов Иван Иванович {title}', rng.randint(1, groups))
+                 for cid, title in enumerate(accounts, start=1)]
+                + [(len(accounts) + 1, support, support, 'support', 1)]
+            )
+            cids = range(1, len(accounts) + 1)
+            await cur.executemany("INSERT INTO contract_parameter_type_phone (cid, value) VALUES (%s, %s)",
+                                  [(cid, f'+7913{cid:07d}') for cid in cids])
+            await cur.executemany("INSERT INTO contract_parameter_type_2 (cid, address) VALUES (%s, %s)",
+                                  [(cid, f'г Новосибирск, ул Ленина, д. {cid}') for cid in cids])
+            await cur.executemany("INSERT INTO contract_parameter_type_3 (cid, email) VALUES (%s, %s)",
+                                  [(cid, f'user{cid}@example.com') for cid in cids])
+            await cur.executemany("INSERT INTO contract_tariff (cid, tpid) VALUES (%s, %s)",
+                                  [(cid, rng.randint(1, len(RATES))) for cid in cids])
+            await cur.executemany(
+                "INSERT INTO contract_balance (cid, yy, mm, summa1, summa2, summa3, summa4) "
+                "VALUES (%s, %s, %s, %s, %s, %s, %s)",
+                [(cid, now.year, now.month, rng.randint(0, 8000), 0, rng.randint(0, 6000), 0) for cid in cids]
+            )
+            payments = []
+            for cid in cids:
+                for _ in range(rng.randint(0, 6)):
+                    paid_at = now - timedelta(days=rng.randint(0, 120), minutes=rng.randint(0, 1440))
+                    payments.append((cid, rng.choice([500, 1000, 3550, 4990]), paid_at.date(), paid_at))
+            await cur.executemany("INSERT INTO contract_payment (cid, summa, dt, lm) VALUES (%s, %s, %s, %s)",
+                                  payments)
+        await conn.commit()
+
+
+async def seed_felix(accounts: list, groups: int, rng: random.Random):
+    now = datetime.now()
+    async with aiomysql.connect(**server_config(), db=database_names()['felix']) as conn:
+        async with conn.cursor() as cur:
+            for statement in FELIX_SCHEMA:
+                await cur.execute(statement)
+            await cur.executemany("INSERT INTO acc_group (id, name) VALUES (%s, %s)",
+                                  [(group_id, f'felix-abons-{group_id}') for group_id in range(1, groups + 1)])
+            await cur.executemany("INSERT INTO tariff (id, name, price) VALUES (%s, %s, %s)",
+                                  [(i, name, price) for i, (name, price) in enumerate(RATES.items(), start=1)])
+            await cur.executemany(
+                "INSERT INTO account (id, login, passwd1, last_name, first_name, patronymic, cell_phone1, email, "
+                "balance, acc_group_id) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+                [(aid, login, login, 'Петров', 'Пётр', 'Петрович', f'+7913{aid:07d}', f'felix{aid}@example.com',
+                  rng.randint(-500, 5000), rng.randint(1, groups))
+                 for aid, login in enumerate(accounts, start=1)]
+            )
+            ids = range(1, len(accounts) + 1)
+            await cur.executemany("INSERT INTO account_service (account_id, tariff_id) VALUES (%s, %s)",
+                                  [(aid, rng.randint(1, len(RATES))) for aid in ids])
+            await cur.executemany(
+                "INSERT INTO payment (account_id, type, date_close) VALUES (%s, %s, %s)",
+                [(aid, 1, int((now + timedelta(days=rng.randint(1, 30))).timestamp())) for aid in ids]
+            )
+            deposits = []
+            for aid in ids:
+                for _ in range(rng.randint(0, 6)):
+                    paid_at = now - timedelta(days=rng.randint(0, 120), minutes=rng.randint(0, 1440))
+                    deposits.append((aid, 1, rng.choice([500, 1000, 3550]), int(paid_at.timestamp()), -1, None,
+                                     'seed'))
+            await cur.executemany(
+                "INSERT INTO deposit (account_id, deposit_type_id, sum, date_add, added_by, ext_id, comment) "
+                "VALUES (%s, %s, %s, %s, %s, %s, %s)",
+                deposits
+            )
+        await conn.commit()
+
+
+async def seed_app(accounts: list, rooms: int, messages_per_room: int, groups: int, rng: random.Random):
+    # Tables come from the app's own migrations so the bench tracks schema changes
+    from db.migrations import migrate, ROOMS_BACKFILL
+
+    await migrate()
+    now = int(datetime.now().timestamp())
+    async with aiomysql.connect(**server_config(), db=database_names()['app']) as conn:
+        async with conn.cursor() as cur:
+            await cur.executemany("INSERT INTO refresh_tokens (user, password) VALUES (%s, %s)",
+                                  [(account, account) for account in accounts])
+            messages = []
+            for account in rng.sample(accounts, min(rooms, len(accounts))):
+                started = now - rng.randint(3600, 90 * 86400)
+                for i in range(messages_per_room):
+                    role = 'user' if i % 3 else 'support'
+                    messages.append((account, role, f'Сообщение {i} в комнате {account}', None, started + i * 60))
+            await cur.executemany(
+                "INSERT INTO messages (room_id, role, message, type_tag, created_at) VALUES (%s, %s, %s, %s, %s)",
+                messages
+            )
+            for statement in ROOMS_BACKFILL:
+                await cur.execute(statement)
+            await cur.executemany(
+                "INSERT INTO news (group_id, location, message) VALUES (%s, %s, %s)",
+                [(group_id, f'bgbilling-abons-{group_id}', f'Новости для группы {group_id}')
+                 for group_id in range(1, groups + 1)]
+                + [(group_id, f'felix-abons-{group_id}', f'Новости для группы {group_id}')
+                   for group_id in range(1, groups + 1)]
+            )
+            await cur.executemany(
+                "INSERT INTO autopayments (user, bindingId, payment_summ, ip, updated) VALUES (%s, %s, %s, %s, %s)",
+                [(account, f'binding-{account}', 500, '127.0.0.1', datetime.now())
+                 for account in rng.sample(accounts, len(accounts) // 10)]
+            )
+            await cur.executemany("INSERT INTO alerts (user, status) VALUES (%s, %s)",
+                                  [(account, 1) for account in rng.sample(accounts, len(accounts) // 50)])
+        await conn.commit()
+
+
+async def seed(subscribers: int, rooms: int, messages_per_room: int, groups: int = 40, seed_value: int = 54) -> dict:
+    rng = random.Random(seed_value)
+    accounts = make_accounts(subscribers)
+    await recreate_databases()
+    await seed_bgbilling(accounts['new'], accounts['support'], groups, rng)
+    await seed_felix(accounts['old'], groups, rng)
+    await seed_app(accounts['old'] + accounts['new'], rooms, messages_per_room, groups, rng)
+    return accounts
@@ -0,0 +1,113 @@
+# Micro-benchmark: per-row cost of list endpoint serialization.
+#
+# "before" builds the Pydantic models the DB helpers used to return and pushes them through
+# FastAPI's response_model validation and JSONResponse, "after" encodes the plain row dicts
+# with ORJSONResponse the way the endpoints do now.
+#
+#   python -m bench.serialization [rows] [repeat]
+import asyncio
+import sys
+import time
+
+from fastapi.responses import JSONResponse, ORJSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from schemas import MessagesList, Message, Rooms, Room, HistoryPaymentsList, News, NewsArticle
+
+
+def message_rows(count: int) -> list:
+    return [(i, 'user' if i % 2 else 'support', f'Сообщение номер {i}, интернет не работает', None, 1716900000 + i)
+            for i in range(count)]
+
+
+def room_rows(count: int) -> list:
+    return [(f'{10000 + i}', *row) for i, row in enumerate(message_rows(count))]
+
+
+def payment_rows(count: int) -> list:
+    return [{'id': i, 'date': '01.06.24 12:00:00', 'summ': 500 + i} for i in range(count)]
+
+
+def news_rows(count: int) -> list:
+    return [(f'Плановые работы на линии, участок {i}',) for i in range(count)]
+
+
+def messages_before(rows):
+    return MessagesList(messages=[Message(id=id, role=role, message=message, type=type_tag, created=int(created))
+                                  for id, role, message, type_tag, created in rows])
+
+
+def messages_after(rows):
+    return {'messages': [{'id': id, 'role': role, 'message': message, 'type': type_tag, 'created': int(created)}
+                         for id, role, message, type_tag, created in rows]}
+
+
+def rooms_before(rows):
+    return Rooms(rooms=[Room(name=room[0], latest_message=Message(id=room[1], role=room[2], message=room[3],
+                                                                  type=room[4], created=int(room[5])))
+                        for room in rows])
+
+
+def rooms_after(rows):
+    return {'rooms': [{'name': room[0], 'latest_message': {'id': room[1], 'role': room[2], 'message': room[3],
+                                                           'type': room[4], 'created': int(room[5])}}
+                      for room in rows]}
+
+
+def payments_before(rows):
+    return {'payments': rows}
+
+
+def payments_after(rows):
+    return {'payments': rows}
+
+
+def news_before(rows):
+    return News(news=[NewsArticle(article=item[0]) for item in rows])
+
+
+def news_after(rows):
+    return {'news': [{'article': item[0]} for item in rows]}
+
+
+CASES = [
+    ('MessagesList', MessagesList, message_rows, messages_before, messages_after),
+    ('Rooms', Rooms, room_rows, rooms_before, rooms_after),
+    ('HistoryPaymentsList', HistoryPaymentsList, payment_rows, payments_before, payments_after),
+    ('News', News, news_rows, news_before, news_after),
+]
+
+
+async def run_before(field, build, rows) -> bytes:
+    content = await serialize_response(field=field, response_content=build(rows), is_coroutine=True)
+    return JSONResponse(content).body
+
+
+async def run_after(build, rows) -> bytes:
+    return ORJSONResponse(build(rows)).body
+
+
+async def measure(coro_factory, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        await coro_factory()
+    return time.perf_counter() - start
+
+
+async def main(count: int, repeat: int):
+    print(f'{"schema":<22}{"before us/row":>15}{"after us/row":>15}{"speedup":>10}')
+    for name, model, make_rows, before, after in CASES:
+        field = create_response_field(name=f'response_{name}', type_=model)
+        rows = make_rows(count)
+        before_time = await measure(lambda: run_before(field, before, rows), repeat)
+        after_time = await measure(lambda: run_after(after, rows), repeat)
+        per_row = 1e6 / (count * repeat)
+        print(f'{name:<22}{before_time * per_row:>15.2f}{after_time * per_row:>15.2f}'
+              f'{before_time / after_time:>9.1f}x')
+
+
+if __name__ == '__main__':
+    rows_arg = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    repeat_arg = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    asyncio.run(main(rows_arg, repeat_arg))
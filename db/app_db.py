@@ -1,25 +1,38 @@
 import asyncio
 import calendar
+import hashlib
 import json
+import logging
 import os
+import re
+import time
+from array import array
+from bisect import bisect_left
 from datetime import datetime, timedelta
 from pprint import pprint
 from typing import Optional
 
-import aiofiles
-import aiomysql
 from dotenv import load_dotenv
 
-from db.billing_db import get_group_id, get_user_data, get_user_data_old
-from schemas import MessagesList, Message, Room, Rooms, News, NewsArticle
+from admission import limited
+from db.billing_db import get_group_id, get_user_data, get_user_data_old, mark_written
+from db.query_stats import execute, executemany
+from db.storage import open_storage
+from metrics import observe_query
+from resilience import resilient
+from schemas import Company
+from singleflight import forget, single_flight
 
 load_dotenv()
 
+logger = logging.getLogger('app_db')
+
 APP_USER = os.getenv('app_db_user')
 APP_PASS = os.getenv('app_db_pass')
 APP_DB_NAME = os.getenv('app_db_name')
 APP_DB_HOST = os.getenv('app_db_host')
-APP_DB_PORT = int(os.getenv('app_db_port'))
+APP_DB_PORT = int(os.getenv('app_db_port', '3306'))
+DB_CONNECT_TIMEOUT = int(os.getenv('db_connect_timeout', '3'))
 
 app_db_config = {
     'user': APP_USER,
@@ -27,6 +40,51 @@ app_db_config = {
     'db': APP_DB_NAME,
     'host': APP_DB_HOST,
     'port': APP_DB_PORT,
+    'connect_timeout': DB_CONNECT_TIMEOUT,
+}
+
+# MySQL or SQLite, per app_db_engine (db/storage.py); helpers take connections from it
+storage = open_storage(app_db_config)
+
+# Accounts currently in an accident, mirrored from the alerts table.
+# Rebound as a whole by load_accident_status / set_accident_status.
+accident_accounts: frozenset = frozenset()
+
+PAYMENT_ORDER_TTL = 3600  # seconds a registered order is polled before it is marked expired
+MESSAGES_PAGE = 20
+FT_MIN_TOKEN_SIZE = 3
+
+# Subscriber accounts per billing backend (Felix: 4 digits, BGBilling: 5) as sorted int arrays. Loaded from
+# refresh_tokens incrementally by id and extended by add_user, so jobs don't rescan the table.
+SUBSCRIBER_WIDTHS = {'old': 4, 'new': 5}
+SUBSCRIBERS_REFRESH_INTERVAL = 60  # seconds between incremental loads
+subscriber_registry = {
+    'old': array('I'),
+    'new': array('I'),
+    'last_id': 0,
+    'loaded_at': float('-inf'),
+    'snapshot': None,
+}
+
+# News responses ({'news': [...]}, shared, treat as read-only) by (group_id, location). Evicted by upsert_news in
+# this process and by sync_news_cache for changes made by other processes.
+NEWS_SYNC_INTERVAL = int(os.getenv('news_cache_sync_seconds', '10'))
+NEWS_SYNC_OVERLAP = 60  # seconds
+news_cache = {}
+news_cache_state = {'generation': 0, 'synced_until': datetime.now()}
+
+REQUISITES_TXT = 'requisites.txt'
+REQUISITES_JSON = 'requisites.json'
+REQUISITES_RELOAD_INTERVAL = 5  # seconds between mtime checks
+
+# Parsed requisites and the pre-encoded /api/requisites body, filled by load_requisites
+requisites_cache = {
+    'text': '',
+    'text_mtime': None,
+    'json': b'',
+    'etag': '',
+    'json_mtime': None,
+    'checked_at': float('-inf'),
 }
 
 
@@ -50,308 +108,398 @@ async def _when_to_pay(account: str):
             return penultimate_date_of_current_month().strftime("%d.%m.%Y")
 
 
-# async def init_db():
-#     async with aiosqlite.connect(DB_NAME) as db:
-#         await db.execute(
-#             "CREATE TABLE IF NOT EXISTS refresh_tokens ("
-#             "id INTEGER PRIMARY KEY AUTOINCREMENT, "
-#             "user TEXT UNIQUE, "
-#             "password TEXT, "
-#             "token TEXT UNIQUE)"
-#         )
-#         await db.execute(
-#             "CREATE TABLE IF NOT EXISTS autopayments ("
-#             "id INTEGER PRIMARY KEY AUTOINCREMENT, "
-#             "user TEXT UNIQUE, "
-#             "bindingId TEXT, "
-#             "payment_summ INTEGER, "
-#             "ip TEXT, "
-#             "updated DATETIME, "
-#             "FOREIGN KEY(user) REFERENCES refresh_tokens(user))"
-#         )
-#
-#         await db.execute(
-#             "CREATE TABLE IF NOT EXISTS alerts ("
-#             "id INTEGER PRIMARY KEY AUTOINCREMENT, "
-#             "user TEXT, "
-#             "status INTEGER, "
-#             "FOREIGN KEY(user) REFERENCES refresh_tokens(user))"
-#         )
-#
-#         await db.execute(
-#             "CREATE TABLE IF NOT EXISTS messages ("
-#             "id INTEGER PRIMARY KEY AUTOINCREMENT, "
-#             "room_id TEXT, "
-#             "role TEXT, "
-#             "message TEXT, "
-#             "type_tag TEXT, "
-#             "created_at INTEGER)"
-#         )
-#
-#         await db.execute(
-#             "CREATE TABLE IF NOT EXISTS news ("
-#             "id INTEGER PRIMARY KEY AUTOINCREMENT, "
-#             "group_id INTEGER, "
-#             "location TEXT, "
-#             "message TEXT)"
-#         )
-#
-#         await db.commit()
-async def init_db():
-    async with aiomysql.create_pool(**app_db_config) as pool:
-        async with pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(
-                    "CREATE TABLE IF NOT EXISTS refresh_tokens ("
-                    "id INT AUTO_INCREMENT PRIMARY KEY, "
-                    "user VARCHAR(255) UNIQUE, "
-                    "password TEXT, "
-                    "token VARCHAR(255) UNIQUE)"
-                )
-                await cur.execute(
-                    "CREATE TABLE IF NOT EXISTS autopayments ("
-                    "id INT AUTO_INCREMENT PRIMARY KEY, "
-                    "user VARCHAR(255) UNIQUE, "
-                    "bindingId TEXT, "
-                    "payment_summ INT, "
-                    "ip TEXT, "
-                    "updated DATETIME, "
-                    "FOREIGN KEY(user) REFERENCES refresh_tokens(user))"
-                )
-
-                await cur.execute(
-                    "CREATE TABLE IF NOT EXISTS alerts ("
-                    "id INT AUTO_INCREMENT PRIMARY KEY, "
-                    "user VARCHAR(255) UNIQUE, "
-                    "status INT, "
-                    "FOREIGN KEY(user) REFERENCES refresh_tokens(user))"
-                )
-
-                await cur.execute(
-                    "CREATE TABLE IF NOT EXISTS messages ("
-                    "id INT AUTO_INCREMENT PRIMARY KEY, "
-                    "room_id TEXT, "
-                    "role TEXT, "
-                    "message TEXT, "
-                    "type_tag TEXT, "
-                    "created_at INT)"
-                )
-
-                await cur.execute(
-                    "CREATE TABLE IF NOT EXISTS news ("
-                    "id INT AUTO_INCREMENT PRIMARY KEY, "
-                    "group_id INT, "
-                    "location VARCHAR(255) UNIQUE, "
-                    "message TEXT)"
-                )
-
-
+@limited('app')
+@resilient('app')
+@observe_query('app')
 async def add_user(user: str, password: str):
-    async with aiomysql.create_pool(**app_db_config) as pool:
-        async with pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(
-                    "INSERT INTO refresh_tokens (user, password) VALUES (%s, %s) ON DUPLICATE KEY UPDATE password = %s",
-                    (user, password, password)
-                )
-            await conn.commit()
-
-
+    async with storage.connection(write=True) as conn:
+        async with conn.cursor() as cur:
+            await execute(
+                cur,
+                "INSERT INTO refresh_tokens (user, password) VALUES (%s, %s) ON DUPLICATE KEY UPDATE password = %s",
+                (user, password, password)
+            )
+        await conn.commit()
+    register_subscriber(user)
+
+
+@limited('app')
+@resilient('app')
+@observe_query('app')
 async def store_refresh_token(user: str, password: str, refresh_token: str):
-    async with aiomysql.create_pool(**app_db_config) as pool:
-        async with pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(
-                    "UPDATE refresh_tokens SET token = %s WHERE user = %s AND password = %s",
-                    (refresh_token, user, password)
-                )
-            await conn.commit()
-
-
+    async with storage.connection(write=True) as conn:
+        async with conn.cursor() as cur:
+            await execute(
+                cur,
+                "UPDATE refresh_tokens SET token = %s WHERE user = %s AND password = %s",
+                (refresh_token, user, password)
+            )
+        await conn.commit()
+
+
+@single_flight()
+@limited('app')
+@resilient('app')
+@observe_query('app')
 async def is_refresh_token_valid(refresh_token: str):
-    async with aiomysql.create_pool(**app_db_config) as pool:
-        async with pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(
-                    "SELECT * FROM refresh_tokens WHERE token = %s",
-                    (refresh_token,)
-                )
-                result = await cur.fetchone()
-                return result is not None
-
-
+    async with storage.connection() as conn:
+        async with conn.cursor() as cur:
+            await execute(
+                cur,
+                "SELECT * FROM refresh_tokens WHERE token = %s",
+                (refresh_token,)
+            )
+            result = await cur.fetchone()
+            return result is not None
+
+
+@limited('app')
+@resilient('app')
+@observe_query('app')
 async def news_exist(location: str, message: str) -> list | None:
-    async with aiomysql.create_pool(**app_db_config) as pool:
-        async with pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute("SELECT message FROM news WHERE location = %s AND message = %s",
-                                  (location, message))
-                result = await cur.fetchone()
-                return result is not None
+    async with storage.connection() as conn:
+        async with conn.cursor() as cur:
+            await execute(cur, "SELECT message FROM news WHERE location = %s AND message = %s",
+                              (location, message))
+            result = await cur.fetchone()
+            return result is not None
 
 
+@limited('app')
+@resilient('app')
+@observe_query('app')
 async def upsert_news(group_id: int, location: str, message: str):
-    async with aiomysql.create_pool(**app_db_config) as pool:
-        async with pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(
-                    """
-                    INSERT INTO news (group_id, location, message)
-                    VALUES (%s, %s, %s) as updates
-                    ON DUPLICATE KEY UPDATE
-                        message = updates.message
-                    """,
-                    (group_id, location, message)
-                )
-            await conn.commit()
-
-
-async def get_group_news(account: str) -> News:
+    # updated_at only moves when the message changes, so re-saving the same sheet rows evicts nothing elsewhere
+    async with storage.connection(write=True) as conn:
+        async with conn.cursor() as cur:
+            await execute(
+                cur,
+                """
+                INSERT INTO news (group_id, location, message, updated_at)
+                VALUES (%s, %s, %s, %s) as updates
+                ON DUPLICATE KEY UPDATE
+                    updated_at = IF(news.message = updates.message, news.updated_at, updates.updated_at),
+                    message = updates.message
+                """,
+                (group_id, location, message, datetime.now())
+            )
+        await conn.commit()
+    _evict_news(group_id, location)
+
+
+def _evict_news(group_id: int, location: str) -> None:
+    news_cache.pop((group_id, location), None)
+    news_cache_state['generation'] += 1
+    forget(group_id)
+
+
+@limited('app')
+@resilient('app')
+@observe_query('app')
+async def sync_news_cache() -> None:
+    # Evict the groups whose news another process (the worker's news and alert jobs) changed since the last
+    # sync. Reads back NEWS_SYNC_OVERLAP seconds before the newest change seen, for writers whose clock lags.
+    since = news_cache_state['synced_until'] - timedelta(seconds=NEWS_SYNC_OVERLAP)
+    async with storage.connection() as conn:
+        async with conn.cursor() as cur:
+            await execute(cur, "SELECT group_id, location, updated_at FROM news WHERE updated_at > %s", (since,))
+            rows = await cur.fetchall()
+    for group_id, location, updated_at in rows:
+        _evict_news(group_id, location)
+        news_cache_state['synced_until'] = max(news_cache_state['synced_until'], updated_at)
+
+
+@single_flight()
+@limited('app')
+@resilient('app', stale=True)
+@observe_query('app')
+async def _load_group_news(group_id: int, location: str) -> dict:
+    generation = news_cache_state['generation']
+    async with storage.connection() as conn:
+        async with conn.cursor() as cur:
+            await execute(
+                cur,
+                "SELECT message FROM news WHERE group_id = %s AND location = %s",
+                (group_id, location)
+            )
+            result = await cur.fetchall()
+    news = {'news': [{'article': item[0]} for item in result]}
+    # Not cached if news changed while it was being read; the next request loads it again
+    if news_cache_state['generation'] == generation:
+        news_cache[(group_id, location)] = news
+    return news
+
+
+async def get_group_news(account: str) -> dict:
+    # Every subscriber of a group shares the same News response, built once per change of the group's news
     group_id, location = await get_group_id(account)
-    async with aiomysql.create_pool(**app_db_config) as pool:
-        async with pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(
-                    "SELECT message FROM news WHERE group_id = %s AND location = %s",
-                    (group_id, location)
-                )
-                result = await cur.fetchall()
-                return News(news=[NewsArticle(article=item[0]) for item in result])
+    news = news_cache.get((group_id, location))
+    if news is None:
+        news = await _load_group_news(group_id, location)
+    return news
 
 
+@single_flight()
+@limited('app')
+@resilient('app')
+@observe_query('app')
 async def is_autopaid(user_id: str) -> bool:
-    async with aiomysql.create_pool(**app_db_config) as pool:
-        async with pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(
-                    "SELECT * FROM autopayments WHERE user = %s",
-                    (user_id,)
-                )
-                result = await cur.fetchone()
-                return result is not None
-
-
+    async with storage.connection() as conn:
+        async with conn.cursor() as cur:
+            await execute(
+                cur,
+                "SELECT * FROM autopayments WHERE user = %s",
+                (user_id,)
+            )
+            result = await cur.fetchone()
+            return result is not None
+
+
+@limited('app')
+@resilient('app')
+@observe_query('app')
 async def set_autopay(user_id: str, binding_id: str, payment_summ: int | float, ip: str):
     last_updated = datetime.now()
-    async with aiomysql.create_pool(**app_db_config) as pool:
-        async with pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                if await is_autopaid(user_id):
-                    await cur.execute(
-                        "UPDATE autopayments SET bindingId = %s, payment_summ = %s, ip = %s, updated = %s "
-                        "WHERE user = %s",
-                        (binding_id, payment_summ, ip, last_updated, user_id)
-                    )
-                else:
-                    await cur.execute(
-                        "INSERT INTO autopayments (user, bindingId, payment_summ, ip, updated) "
-                        "VALUES (%s, %s, %s, %s, %s)",
-                        (user_id, binding_id, payment_summ, ip, last_updated)
-                    )
-            await conn.commit()
-
-
-async def get_autopay(user_id):
-    async with aiomysql.create_pool(**app_db_config) as pool:
-        async with pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(
-                    "SELECT bindingId, payment_summ FROM autopayments WHERE user = %s",
-                    (user_id,)
+    async with storage.connection(write=True) as conn:
+        async with conn.cursor() as cur:
+            if await is_autopaid(user_id):
+                await execute(
+                    cur,
+                    "UPDATE autopayments SET bindingId = %s, payment_summ = %s, ip = %s, updated = %s "
+                    "WHERE user = %s",
+                    (binding_id, payment_summ, ip, last_updated, user_id)
                 )
-                result = await cur.fetchone()
-                if result is not None and result[0] is not None:
-                    pay_day = penultimate_date_of_current_month().strftime("%d.%m.%Y")
-                    return {
-                        "enabled": True,
-                        "pay_day": pay_day,
-                        "pay_summ": result[1]
-                    }
-                else:
-                    return {
-                        "enabled": False,
-                        "pay_day": '',
-                        "pay_summ": 0.0
-                    }
-
-
-async def get_autopay_users():
-    async with aiomysql.create_pool(**app_db_config) as pool:
-        async with pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(
-                    "SELECT user, bindingId, payment_summ, ip, updated FROM autopayments WHERE bindingId IS NOT NULL"
+            else:
+                await execute(
+                    cur,
+                    "INSERT INTO autopayments (user, bindingId, payment_summ, ip, updated) "
+                    "VALUES (%s, %s, %s, %s, %s)",
+                    (user_id, binding_id, payment_summ, ip, last_updated)
                 )
-                result = await cur.fetchall()
-                return result
+        await conn.commit()
+    forget(user_id)
 
 
+@single_flight()
+@limited('app')
+@resilient('app', stale=True)
+@observe_query('app')
+async def get_autopay(user_id):
+    async with storage.connection() as conn:
+        async with conn.cursor() as cur:
+            await execute(
+                cur,
+                "SELECT bindingId, payment_summ FROM autopayments WHERE user = %s",
+                (user_id,)
+            )
+            result = await cur.fetchone()
+            if result is not None and result[0] is not None:
+                pay_day = penultimate_date_of_current_month().strftime("%d.%m.%Y")
+                return {
+                    "enabled": True,
+                    "pay_day": pay_day,
+                    "pay_summ": result[1]
+                }
+            else:
+                return {
+                    "enabled": False,
+                    "pay_day": '',
+                    "pay_summ": 0.0
+                }
+
+
+@limited('app')
+@resilient('app')
+@observe_query('app')
+async def get_autopay_users():
+    async with storage.connection() as conn:
+        async with conn.cursor() as cur:
+            await execute(
+                cur,
+                "SELECT user, bindingId, payment_summ, ip, updated FROM autopayments WHERE bindingId IS NOT NULL"
+            )
+            result = await cur.fetchall()
+            return result
+
+
+@limited('app')
+@resilient('app')
+@observe_query('app')
 async def delete_autopay(user_id: str):
-    async with aiomysql.create_pool(**app_db_config) as pool:
-        async with pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                last_updated = datetime.now()
-                await cur.execute(
-                    "UPDATE autopayments SET bindingId = NULL, payment_summ = NULL, updated = %s WHERE user = %s",
-                    (last_updated, user_id)
-                )
-            await conn.commit()
+    async with storage.connection(write=True) as conn:
+        async with conn.cursor() as cur:
+            last_updated = datetime.now()
+            await execute(
+                cur,
+                "UPDATE autopayments SET bindingId = NULL, payment_summ = NULL, updated = %s WHERE user = %s",
+                (last_updated, user_id)
+            )
+        await conn.commit()
+    forget(user_id)
+
+
+@limited('app')
+@resilient('app')
+@observe_query('app')
+async def add_payment_order(order_id: str, user: str, autopay: bool) -> None:
+    # Orders are reconciled against the bank by the background worker (tasks.reconcile_payments)
+    async with storage.connection(write=True) as conn:
+        async with conn.cursor() as cur:
+            await execute(
+                cur,
+                "INSERT INTO payment_orders (order_id, user, autopay, created_at) VALUES (%s, %s, %s, %s)",
+                (order_id, user, int(autopay), int(datetime.now().timestamp()))
+            )
+        await conn.commit()
+    # The balance changes once the worker reconciles the order; keep the subscriber's billing reads on the primary
+    await mark_written(user, PAYMENT_ORDER_TTL)
+
+
+@limited('app')
+@resilient('app')
+@observe_query('app')
+async def set_billing_written(account: str, until: float) -> None:
+    async with storage.connection(write=True) as conn:
+        async with conn.cursor() as cur:
+            await execute(
+                cur,
+                "INSERT INTO billing_writes (account, written_until) VALUES (%s, %s) AS new "
+                "ON DUPLICATE KEY UPDATE written_until = GREATEST(billing_writes.written_until, new.written_until)",
+                (str(account), until)
+            )
+        await conn.commit()
+
+
+@limited('app')
+@resilient('app')
+@observe_query('app')
+async def get_billing_written_until(account: str) -> float:
+    # Unix time until which the account's billing reads stay on the primary; 0 when it wasn't written recently
+    async with storage.connection() as conn:
+        async with conn.cursor() as cur:
+            await execute(cur, "SELECT written_until FROM billing_writes WHERE account = %s", (str(account),))
+            row = await cur.fetchone()
+    return row[0] if row else 0
+
+
+@limited('app')
+@resilient('app')
+@observe_query('app')
+async def get_open_payment_orders() -> list:
+    async with storage.connection() as conn:
+        async with conn.cursor() as cur:
+            await execute(
+                cur,
+                "SELECT order_id, user, autopay, created_at, state FROM payment_orders WHERE state IN %s",
+                (('pending', 'crediting'),)
+            )
+            return await cur.fetchall()
+
+
+@limited('app')
+@resilient('app')
+@observe_query('app')
+async def transition_payment_order(order_id: str, from_state: str, to_state: str) -> bool:
+    # Move the order on only if it is still in from_state; False when another run (on any worker) got there first.
+    # States: pending -> crediting -> done, pending -> declined | expired. An order left in crediting had its
+    # credit fail or time out half-way; reconcile_payments retries it, which the billings credit only once.
+    async with storage.connection(write=True) as conn:
+        async with conn.cursor() as cur:
+            await execute(cur, "UPDATE payment_orders SET state = %s WHERE order_id = %s AND state = %s",
+                          (to_state, order_id, from_state))
+            moved = cur.rowcount == 1
+        await conn.commit()
+    return moved
+
+
+async def _touch_room(cur, room_id: str, by_support: bool) -> None:
+    # Point the room at its latest message. A subscriber's message adds to unread and marks the room awaiting
+    # a reply (and requiring action if the auto-response asked for an operator); an operator reply clears all
+    # three. Preview columns only move forward in case a concurrent write for the room committed first.
+    await execute(
+        cur,
+        "SELECT id, role, message, type_tag, created_at FROM messages WHERE room_id = %s ORDER BY id DESC LIMIT 1",
+        (room_id,)
+    )
+    last_id, last_role, last_message, last_type_tag, last_created_at = await cur.fetchone()
+    requires_action = not by_support and last_type_tag == 'autoResponseRequiresAction'
+    await execute(
+        cur,
+        """
+        INSERT INTO rooms (room_id, last_message_id, last_role, last_message, last_type_tag, last_created_at,
+                           unread, awaiting_reply, requires_action)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) AS new
+        ON DUPLICATE KEY UPDATE
+            unread = IF(new.awaiting_reply, rooms.unread + new.unread, 0),
+            requires_action = IF(new.awaiting_reply, rooms.requires_action OR new.requires_action, 0),
+            awaiting_reply = new.awaiting_reply,
+            last_role = IF(new.last_message_id > rooms.last_message_id, new.last_role, rooms.last_role),
+            last_message = IF(new.last_message_id > rooms.last_message_id, new.last_message, rooms.last_message),
+            last_type_tag = IF(new.last_message_id > rooms.last_message_id, new.last_type_tag, rooms.last_type_tag),
+            last_created_at = IF(new.last_message_id > rooms.last_message_id, new.last_created_at,
+                                 rooms.last_created_at),
+            last_message_id = GREATEST(rooms.last_message_id, new.last_message_id)
+        """,
+        (room_id, last_id, last_role, last_message, last_type_tag, int(last_created_at),
+         int(not by_support), int(not by_support), int(requires_action))
+    )
+
+
+async def _auto_response(room_id: str, type_tag: Optional[str]) -> Optional[tuple[str, str]]:
+    # (message, type_tag) of the support reply to a tagged message, or None
+    if type_tag == 'noInternet' and await get_accident_status(room_id):
+        return 'Ожидайте восстановления, уже работаем.', 'autoResponse'
+    elif type_tag == 'noInternet' and not await get_accident_status(room_id):
+        return 'Пожалуйста, подождите, оператор скоро ответит.', 'autoResponse'
+    elif type_tag == 'routerNotWork':
+        return ('Перезагрузите ваш роутер:\n\n'
+                '1. Отключить питание (выдернуть из розетки)\n'
+                '2. Подождать 1,5 минуты\n'
+                '3. Подключить питание'), 'autoResponse'
+    elif type_tag == 'whenToPay':
+        pay_day = await _when_to_pay(room_id)
+        return f'Следующая дата оплаты: {pay_day}', 'autoResponse'
+    elif type_tag == 'requisites':
+        return get_requisites(), 'autoResponse'
+    elif type_tag in ['tvNotWork', 'deviceNotWork', 'support']:
+        return 'Пожалуйста, подождите, оператор скоро ответит.', 'autoResponseRequiresAction'
+    return None
 
 
 async def add_message(room_id: str, role: str, message: str, type_tag: Optional[str] = None) -> None:
-    async with aiomysql.create_pool(**app_db_config) as pool:
-        async with pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                created_at = datetime.now().timestamp()
-                await cur.execute(
-                    "INSERT INTO messages (room_id, role, message, created_at) VALUES (%s, %s, %s, %s)",
-                    (room_id, role, message, created_at)
+    # The auto-response may need billing (whenToPay): resolve it before taking the app DB's writer, so the
+    # billing call holds neither the write transaction nor the app DB's slot, timeout and breaker
+    auto_response = await _auto_response(room_id, type_tag)
+    await _insert_message(room_id, role, message, type_tag, auto_response)
+    forget(room_id)
+
+
+@limited('app')
+@resilient('app')
+@observe_query('app')
+async def _insert_message(room_id: str, role: str, message: str, type_tag: Optional[str],
+                          auto_response: Optional[tuple[str, str]]) -> None:
+    async with storage.connection(write=True) as conn:
+        async with conn.cursor() as cur:
+            created_at = datetime.now().timestamp()
+            await execute(
+                cur,
+                "INSERT INTO messages (room_id, role, message, created_at) VALUES (%s, %s, %s, %s)",
+                (room_id, role, message, created_at)
+            )
+            if auto_response:
+                await execute(
+                    cur,
+                    "INSERT INTO messages (room_id, role, message, type_tag, created_at) VALUES (%s, %s, %s, %s, %s)",
+                    (room_id, 'support', *auto_response, created_at)
                 )
-                if type_tag == 'noInternet' and await get_accident_status(room_id):
-                    message = 'Ожидайте восстановления, уже работаем.'
-                    await cur.execute(
-                        "INSERT INTO messages (room_id, role, message, type_tag, created_at) VALUES (%s, %s, %s, %s, %s)",
-                        (room_id, 'support', message, 'autoResponse', created_at)
-                    )
-                elif type_tag == 'noInternet' and not await get_accident_status(room_id):
-                    message = 'Пожалуйста, подождите, оператор скоро ответит.'
-                    await cur.execute(
-                        "INSERT INTO messages (room_id, role, message, type_tag, created_at) VALUES (%s, %s, %s, %s, %s)",
-                        (room_id, 'support', message, 'autoResponse', created_at)
-                    )
-                elif type_tag == 'routerNotWork':
-                    message = ('Перезагрузите ваш роутер:\n\n'
-                               '1. Отключить питание (выдернуть из розетки)\n'
-                               '2. Подождать 1,5 минуты\n'
-                               '3. Подключить питание')
-                    await cur.execute(
-                        "INSERT INTO messages (room_id, role, message, type_tag, created_at) VALUES (%s, %s, %s, %s, %s)",
-                        (room_id, 'support', message, 'autoResponse', created_at)
-                    )
-                elif type_tag == 'whenToPay':
-                    pay_day = await _when_to_pay(room_id)
-                    message = f'Следующая дата оплаты: {pay_day}'
-                    await cur.execute(
-                        "INSERT INTO messages (room_id, role, message, type_tag, created_at) VALUES (%s, %s, %s, %s, %s)",
-                        (room_id, 'support', message, 'autoResponse', created_at)
-                    )
-                elif type_tag == 'requisites':
-                    message = await get_requisites()
-                    await cur.execute(
-                        "INSERT INTO messages (room_id, role, message, type_tag, created_at) VALUES (%s, %s, %s, %s, %s)",
-                        (room_id, 'support', message, 'autoResponse', created_at)
-                    )
-                elif type_tag in ['tvNotWork', 'deviceNotWork', 'support']:
-                    message = 'Пожалуйста, подождите, оператор скоро ответит.'
-                    await cur.execute(
-                        "INSERT INTO messages (room_id, role, message, type_tag, created_at) VALUES (%s, %s, %s, %s, %s)",
-                        (room_id, 'support', message, 'autoResponseRequiresAction', created_at)
-                    )
-            await conn.commit()
+            await _touch_room(cur, room_id, by_support=role == 'support' and type_tag is None)
+        await conn.commit()
 
 
-async def get_messages(room_id: str, less_id: Optional[int] = None, greater_id: Optional[int] = None) -> MessagesList:
-    query = "SELECT id, role, message, type_tag, created_at FROM messages WHERE room_id = %s"
+def _messages_query(table: str, room_id: str, less_id: Optional[int], greater_id: Optional[int],
+                    limit: int) -> tuple[str, list]:
+    query = f"SELECT id, role, message, type_tag, created_at FROM {table} WHERE room_id = %s"
     params = [room_id]
 
     if less_id is not None:
@@ -362,122 +510,412 @@ async def get_messages(room_id: str, less_id: Optional[int] = None, greater_id:
         query += " AND id > %s"
         params.append(greater_id)
 
-    query += " ORDER BY created_at DESC LIMIT 20"
-
-    async with aiomysql.create_pool(**app_db_config) as pool:
-        async with pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(query, params)
-                result = await cur.fetchall()
-    message_instances = [Message(id=id, role=role, message=message, type=type_tag, created=int(created))
-                         for id, role, message, type_tag, created in sorted(result)]
-    return MessagesList(messages=message_instances)
-
-
-async def get_rooms():
-    query = """SELECT
-                    m1.room_id,
-                    m2.id AS _latest_message_id_,
-                    m2.role,
-                    m2.message AS _latest_message_,
-                    m2.type_tag,
-                    m2.created_at AS _latest_message_created_at_
-                FROM
-                    messages m1
-                    JOIN (
-                        SELECT
-                            room_id,
-                            id,
-                            role,
-                            message,
-                            type_tag,
-                            created_at,
-                            ROW_NUMBER() OVER (PARTITION BY room_id ORDER BY id DESC) AS rn
-                        FROM
-                            messages
-                    ) m2 ON m1.room_id = m2.room_id AND m2.rn = 1
-                GROUP BY
-                    m1.room_id,
-                    m2.id,
-                    m2.role,
-                    m2.message,
-                    m2.created_at
-                ORDER BY
-                    _latest_message_created_at_ DESC"""
-    async with aiomysql.create_pool(**app_db_config) as pool:
-        async with pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(query, )
-                result = await cur.fetchall()
-    room_instances = [Room(name=room[0],
-                           latest_message=Message(id=room[1],
-                                                  role=room[2],
-                                                  message=room[3],
-                                                  type=room[4],
-                                                  created=int(room[5])))
-                      for room in result]
-    return Rooms(rooms=room_instances)
-
-
-async def get_accounts():
-    async with aiomysql.create_pool(**app_db_config) as pool:
-        async with pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute("SELECT user FROM refresh_tokens")
-                users = await cur.fetchall()
-                old_accounts = [user[0] for user in users if len(user[0]) == 4]
-                new_accounts = [user[0] for user in users if len(user[0]) == 5]
-                return {"old": old_accounts, "new": new_accounts}
-
-
-async def get_accident_status(account: str):
-    async with aiomysql.create_pool(**app_db_config) as pool:
-        async with pool.acquire() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute("SELECT status FROM alerts WHERE user = %s", (account,))
-                status = await cursor.fetchone()
-
-                if status is not None and status[0]:
-                    return True
-                else:
-                    return False
-
-
-async def set_accident_status(accounts: list) -> None:
-    async with aiomysql.create_pool(**app_db_config) as pool:
-        async with pool.acquire() as conn:
-            async with conn.cursor() as cursor:
-                # Reset all statuses to 0
-                await cursor.execute("UPDATE alerts SET status = %s", (0,))
-
-                # Prepare data for batch operations
-                account_statuses = []
-
-                for account in accounts:
-                    current_status = await get_accident_status(account)
-                    if not current_status:
-                        account_statuses.append((str(account), 1))
-
-                # Perform batch inserts or updates
-                if account_statuses:
-                    await cursor.executemany(
-                        """
-                        INSERT INTO alerts (user, status) 
-                        VALUES (%s, %s) AS new
-                        ON DUPLICATE KEY UPDATE status = new.status
-                        """,
-                        account_statuses
-                    )
-
-                # Commit all changes
-                await conn.commit()
-
-
-async def get_requisites():
-    async with aiofiles.open('requisites.txt', mode='r') as file:
-        return await file.read()
-
-
-async def get_requisites_json():
-    async with aiofiles.open('requisites.json', mode='r') as file:
-        return json.loads(await file.read())
+    # id follows insertion order and is what less_id / greater_id page on; served by the (room_id, id) index
+    query += " ORDER BY id DESC LIMIT %s"
+    params.append(limit)
+    return query, params
+
+
+async def _archived_upto(cur, room_id: str) -> Optional[int]:
+    # Highest id of the room's messages in messages_archive, None when none were archived
+    await execute(cur, "SELECT archived_upto_id FROM rooms WHERE room_id = %s", (room_id,))
+    row = await cur.fetchone()
+    return row[0] if row else None
+
+
+@single_flight()
+@limited('app')
+@resilient('app')
+@observe_query('app')
+async def get_messages(room_id: str, less_id: Optional[int] = None, greater_id: Optional[int] = None) -> dict:
+    async with storage.connection() as conn:
+        async with conn.cursor() as cur:
+            await execute(cur, *_messages_query('messages', room_id, less_id, greater_id, MESSAGES_PAGE))
+            result = list(await cur.fetchall())
+            # Older history of archived rooms continues in messages_archive under the same ids, so a page
+            # the hot table can't fill is topped up from there, for rooms archive_rooms has moved messages of.
+            # New messages only ever land in the hot table, which is all greater_id polling reads.
+            if len(result) < MESSAGES_PAGE and greater_id is None and await _archived_upto(cur, room_id):
+                before = min(row[0] for row in result) if result else less_id
+                await execute(cur, *_messages_query('messages_archive', room_id, before, None,
+                                                    MESSAGES_PAGE - len(result)))
+                result += await cur.fetchall()
+    # Rows are emitted as plain dicts shaped like MessagesList and encoded once by the endpoint
+    messages = [{'id': id, 'role': role, 'message': message, 'type': type_tag, 'created': int(created)}
+                for id, role, message, type_tag, created in sorted(result)]
+    return {'messages': messages}
+
+
+def _search_terms(text: str) -> str:
+    # Every word must match, as a prefix; operators typed by the operator are dropped, and so are words shorter
+    # than innodb_ft_min_token_size, which aren't in the MySQL index
+    words = [word for word in re.sub(r'[+\-<>()~*"@:^]', ' ', text).split() if len(word) >= FT_MIN_TOKEN_SIZE]
+    if storage.dialect == 'sqlite':
+        return ' '.join(f'"{word}"*' for word in words)
+    return ' '.join(f'+{word}*' for word in words)
+
+
+# Per engine: MySQL FULLTEXT indexes, SQLite FTS5 tables kept in sync by triggers (db/migrations.py)
+SEARCH_QUERIES = {
+    'mysql': "SELECT id, room_id, role, message, type_tag, created_at FROM {table} "
+             "WHERE MATCH(message) AGAINST (%s IN BOOLEAN MODE) AND id < %s ORDER BY id DESC LIMIT %s",
+    'sqlite': "SELECT m.id, m.room_id, m.role, m.message, m.type_tag, m.created_at FROM {table}_fts f "
+              "JOIN {table} m ON m.id = f.rowid WHERE {table}_fts MATCH %s AND f.rowid < %s "
+              "ORDER BY f.rowid DESC LIMIT %s",
+}
+
+
+@single_flight()
+@limited('app')
+@resilient('app')
+@observe_query('app')
+async def search_messages(text: str, less_id: Optional[int] = None, limit: int = 50) -> dict:
+    # Full-text search over hot and archived messages, newest first; page on with less_id=next_less_id
+    terms = _search_terms(text)
+    if not terms:
+        return {'messages': [], 'next_less_id': None}
+    before = less_id if less_id is not None else 2 ** 31 - 1
+    result = []
+    async with storage.connection() as conn:
+        async with conn.cursor() as cur:
+            for table in ('messages', 'messages_archive'):
+                await execute(cur, SEARCH_QUERIES[storage.dialect].format(table=table), (terms, before, limit))
+                result += await cur.fetchall()
+    result = sorted(result, reverse=True)[:limit]
+    messages = [{'id': id, 'room_id': room_id, 'role': role, 'message': message, 'type': type_tag,
+                 'created': int(created)}
+                for id, room_id, role, message, type_tag, created in result]
+    return {'messages': messages, 'next_less_id': result[-1][0] if len(result) == limit else None}
+
+
+@single_flight()
+@limited('app')
+@resilient('app')
+@observe_query('app')
+async def get_rooms(less_id: Optional[int] = None, limit: int = 50, awaiting_reply: bool = False,
+                    requires_action: bool = False, accident: bool = False) -> dict:
+    # Rooms by last activity, newest first; page on with less_id=next_less_id
+    query = ("SELECT r.room_id, r.last_message_id, r.last_role, r.last_message, r.last_type_tag, r.last_created_at, "
+             "r.unread, r.awaiting_reply, r.requires_action, a.status "
+             "FROM rooms r LEFT JOIN alerts a ON a.user = r.room_id WHERE TRUE")
+    params = []
+
+    if less_id is not None:
+        query += " AND r.last_message_id < %s"
+        params.append(less_id)
+
+    if awaiting_reply:
+        query += " AND r.awaiting_reply = 1"
+
+    if requires_action:
+        query += " AND r.requires_action = 1"
+
+    if accident:
+        query += " AND a.status = 1"
+
+    query += " ORDER BY r.last_message_id DESC LIMIT %s"
+    params.append(limit)
+
+    async with storage.connection() as conn:
+        async with conn.cursor() as cur:
+            await execute(cur, query, params)
+            result = await cur.fetchall()
+    rooms = [{'name': room[0],
+              'latest_message': {'id': room[1],
+                                 'role': room[2],
+                                 'message': room[3],
+                                 'type': room[4],
+                                 'created': int(room[5])},
+              'unread': room[6],
+              'awaiting_reply': bool(room[7]),
+              'requires_action': bool(room[8]),
+              'accident': room[9] == 1}
+             for room in result]
+    return {'rooms': rooms, 'next_less_id': result[-1][1] if len(result) == limit else None}
+
+
+@limited('app')
+@resilient('app')
+@observe_query('app')
+async def mark_room_read(room_id: str) -> None:
+    async with storage.connection(write=True) as conn:
+        async with conn.cursor() as cur:
+            await execute(cur, "UPDATE rooms SET unread = 0 WHERE room_id = %s AND unread > 0", (room_id,))
+        await conn.commit()
+
+
+@limited('app')
+@resilient('app')
+@observe_query('app')
+async def get_idle_rooms(idle_since: int, limit: int) -> list:
+    # Rooms whose latest message is older than idle_since; MAX(id) per room is read off idx_messages_room
+    async with storage.connection() as conn:
+        async with conn.cursor() as cur:
+            await execute(
+                cur,
+                "SELECT m.room_id FROM (SELECT room_id, MAX(id) AS last_id FROM messages GROUP BY room_id) latest "
+                "JOIN messages m ON m.id = latest.last_id WHERE m.created_at < %s LIMIT %s",
+                (idle_since, limit)
+            )
+            return [row[0] for row in await cur.fetchall()]
+
+
+@limited('app')
+@resilient('app')
+@observe_query('app')
+async def archive_rooms(rooms: list) -> int:
+    # Move the rooms' messages to messages_archive in one transaction. Bounded by the highest id seen
+    # first, so a message arriving in the meantime stays in the hot table instead of being lost.
+    if not rooms:
+        return 0
+    rooms = tuple(rooms)
+    async with storage.connection(write=True) as conn:
+        async with conn.cursor() as cur:
+            await conn.begin()
+            await execute(cur, "SELECT MAX(id) FROM messages WHERE room_id IN %s", (rooms,))
+            (last_id,) = await cur.fetchone()
+            if last_id is None:
+                await conn.rollback()
+                return 0
+            await execute(
+                cur,
+                "INSERT INTO messages_archive (id, room_id, role, message, type_tag, created_at) "
+                "SELECT id, room_id, role, message, type_tag, created_at FROM messages "
+                "WHERE room_id IN %s AND id <= %s",
+                (rooms, last_id)
+            )
+            moved = cur.rowcount
+            await execute(
+                cur,
+                "UPDATE rooms SET archived_upto_id = (SELECT MAX(id) FROM messages_archive "
+                "WHERE messages_archive.room_id = rooms.room_id) WHERE room_id IN %s",
+                (rooms,)
+            )
+            await execute(cur, "DELETE FROM messages WHERE room_id IN %s AND id <= %s", (rooms, last_id))
+        await conn.commit()
+    return moved
+
+
+@limited('app')
+@resilient('app')
+@observe_query('app')
+async def get_calendar_accounts() -> set:
+    async with storage.connection() as conn:
+        async with conn.cursor() as cur:
+            await execute(cur, "SELECT account FROM pay_days")
+            return {row[0] for row in await cur.fetchall()}
+
+
+@limited('app')
+@resilient('app')
+@observe_query('app')
+async def get_stale_pay_days(updated_before: datetime, limit: int) -> list:
+    async with storage.connection() as conn:
+        async with conn.cursor() as cur:
+            await execute(
+                cur,
+                "SELECT account FROM pay_days WHERE updated_at < %s ORDER BY updated_at LIMIT %s",
+                (updated_before, limit)
+            )
+            return [row[0] for row in await cur.fetchall()]
+
+
+@limited('app')
+@resilient('app')
+@observe_query('app')
+async def save_pay_days(pay_days: list) -> None:
+    # pay_days: [(account, next pay date or None), ...]
+    if not pay_days:
+        return
+    updated_at = datetime.now()
+    async with storage.connection(write=True) as conn:
+        async with conn.cursor() as cur:
+            await executemany(
+                cur,
+                """
+                INSERT INTO pay_days (account, next_pay_date, updated_at)
+                VALUES (%s, %s, %s) AS new
+                ON DUPLICATE KEY UPDATE next_pay_date = new.next_pay_date, updated_at = new.updated_at
+                """,
+                [(account, pay_date, updated_at) for account, pay_date in pay_days]
+            )
+        await conn.commit()
+
+
+@limited('app')
+@resilient('app')
+@observe_query('app')
+async def get_accounts_paying_on(pay_date, after: str = '', limit: int = 1000) -> list:
+    # One page of the accounts due on pay_date, in account order; continue with after=<last account>
+    async with storage.connection() as conn:
+        async with conn.cursor() as cur:
+            await execute(
+                cur,
+                "SELECT account FROM pay_days WHERE next_pay_date = %s AND account > %s ORDER BY account LIMIT %s",
+                (pay_date, after, limit)
+            )
+            return [row[0] for row in await cur.fetchall()]
+
+
+def register_subscriber(account: str) -> None:
+    account = str(account)
+    for backend, width in SUBSCRIBER_WIDTHS.items():
+        if len(account) == width and account.isdigit():
+            numbers = subscriber_registry[backend]
+            number = int(account)
+            i = bisect_left(numbers, number)
+            if i == len(numbers) or numbers[i] != number:
+                numbers.insert(i, number)
+                subscriber_registry['snapshot'] = None
+
+
+@limited('app')
+@resilient('app')
+@observe_query('app')
+async def refresh_subscribers() -> None:
+    # Load only the refresh_tokens rows added since the last load (accounts of other API processes' logins)
+    async with storage.connection() as conn:
+        async with conn.cursor() as cur:
+            await execute(cur, "SELECT id, user FROM refresh_tokens WHERE id > %s ORDER BY id",
+                          (subscriber_registry['last_id'],))
+            rows = await cur.fetchall()
+    if rows:
+        for backend, width in SUBSCRIBER_WIDTHS.items():
+            added = {int(user) for _, user in rows if len(user) == width and user.isdigit()}
+            if added:
+                subscriber_registry[backend] = array('I', sorted(added.union(subscriber_registry[backend])))
+        subscriber_registry['last_id'] = rows[-1][0]
+        subscriber_registry['snapshot'] = None
+    subscriber_registry['loaded_at'] = time.monotonic()
+
+
+async def get_accounts() -> dict:
+    # Snapshot of the registry, {"old": (Felix accounts...), "new": (BGBilling accounts...)}; shared between
+    # callers and rebuilt only when an account was added, so treat it as read-only
+    if time.monotonic() - subscriber_registry['loaded_at'] > SUBSCRIBERS_REFRESH_INTERVAL:
+        await refresh_subscribers()
+    if subscriber_registry['snapshot'] is None:
+        subscriber_registry['snapshot'] = {
+            backend: tuple(f'{number:0{width}d}' for number in subscriber_registry[backend])
+            for backend, width in SUBSCRIBER_WIDTHS.items()
+        }
+    return subscriber_registry['snapshot']
+
+
+@limited('app')
+@resilient('app')
+@observe_query('app')
+async def load_accident_status() -> None:
+    # Re-sync the in-memory accident set from the alerts table (called on startup)
+    global accident_accounts
+    async with storage.connection() as conn:
+        async with conn.cursor() as cursor:
+            await execute(cursor, "SELECT user FROM alerts WHERE status = %s", (1,))
+            rows = await cursor.fetchall()
+            accident_accounts = frozenset(row[0] for row in rows)
+
+
+async def get_accident_status(account: str) -> bool:
+    return account in accident_accounts
+
+
+@limited('app')
+@resilient('app')
+@observe_query('app')
+async def set_accident_status(accounts: list) -> dict:
+    # Diff the reported accounts against the stored affected set and write only the transitions
+    global accident_accounts
+    async with storage.connection(write=True) as conn:
+        async with conn.cursor() as cursor:
+            await execute(cursor, "SELECT user FROM alerts WHERE status = %s", (1,))
+            current = {row[0] for row in await cursor.fetchall()}
+            reported = {str(account) for account in accounts}
+
+            affected = reported - current
+            recovered = current - reported
+
+            if affected:
+                await executemany(
+                    cursor,
+                    """
+                    INSERT INTO alerts (user, status, notified) 
+                    VALUES (%s, %s, %s) AS new
+                    ON DUPLICATE KEY UPDATE status = new.status, notified = new.notified
+                    """,
+                    [(account, 1, 0) for account in affected]
+                )
+
+            if recovered:
+                await execute(cursor, "UPDATE alerts SET status = %s WHERE user IN %s",
+                                     (0, tuple(recovered)))
+
+            await conn.commit()
+
+    accident_accounts = frozenset(reported)
+    return {"affected": sorted(affected), "recovered": sorted(recovered)}
+
+
+@limited('app')
+@resilient('app')
+@observe_query('app')
+async def get_unnotified_alerts() -> list:
+    # Accounts in an accident whose push hasn't been delivered yet: newly affected ones and earlier failures
+    async with storage.connection() as conn:
+        async with conn.cursor() as cursor:
+            await execute(cursor, "SELECT user FROM alerts WHERE status = %s AND notified = %s", (1, 0))
+            return [row[0] for row in await cursor.fetchall()]
+
+
+@limited('app')
+@resilient('app')
+@observe_query('app')
+async def mark_alerts_notified(accounts: list) -> None:
+    if not accounts:
+        return
+    async with storage.connection(write=True) as conn:
+        async with conn.cursor() as cursor:
+            await execute(cursor, "UPDATE alerts SET notified = %s WHERE user IN %s", (1, tuple(accounts)))
+            await conn.commit()
+
+
+def load_requisites() -> None:
+    # (Re)load requisites files whose mtime changed since the last load. A missing or malformed file (e.g. caught
+    # half-written) is logged and the last good version kept; it is read again once its mtime changes.
+    try:
+        text_mtime = os.stat(REQUISITES_TXT).st_mtime_ns
+        if text_mtime != requisites_cache['text_mtime']:
+            requisites_cache['text_mtime'] = text_mtime
+            with open(REQUISITES_TXT, mode='r') as file:
+                requisites_cache['text'] = file.read()
+    except OSError as e:
+        logger.error('could not load %s: %s', REQUISITES_TXT, e)
+
+    try:
+        json_mtime = os.stat(REQUISITES_JSON).st_mtime_ns
+        if json_mtime != requisites_cache['json_mtime']:
+            requisites_cache['json_mtime'] = json_mtime
+            with open(REQUISITES_JSON, mode='r') as file:
+                company = Company(**json.load(file))
+            body = json.dumps(company.model_dump(), ensure_ascii=False, separators=(",", ":")).encode('utf-8')
+            requisites_cache['json'] = body
+            requisites_cache['etag'] = f'"{hashlib.sha256(body).hexdigest()}"'
+    except (OSError, ValueError, TypeError) as e:
+        # json.JSONDecodeError and pydantic's ValidationError are ValueErrors; TypeError for a non-object document
+        logger.error('could not load %s, keeping the last good requisites: %s', REQUISITES_JSON, e)
+
+    requisites_cache['checked_at'] = time.monotonic()
+
+
+def _fresh_requisites() -> dict:
+    if time.monotonic() - requisites_cache['checked_at'] > REQUISITES_RELOAD_INTERVAL:
+        load_requisites()
+    return requisites_cache
+
+
+def get_requisites() -> str:
+    return _fresh_requisites()['text']
+
+
+def get_requisites_json() -> tuple[bytes, str]:
+    cache = _fresh_requisites()
+    return cache['json'], cache['etag']
@@ -8,12 +8,21 @@ from typing import Dict, Any, List
 
 import aiomysql
 import asyncio
+import logging
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 
+from admission import limited
+from db.query_stats import execute
+from metrics import DB_READS, REPLICA_LAG, observe_query
+from resilience import resilient
 from schemas import UserData, Rate
+from singleflight import forget, single_flight
 
 load_dotenv()
 
+logger = logging.getLogger('billing_db')
+
 USER = os.getenv('billing_db_user')
 PASS = os.getenv('billing_db_pass')
 DB_NAME = os.getenv('billing_db_name')
@@ -25,12 +34,15 @@ OLD_PASS = os.getenv('old_billing_db_pass')
 OLD_DB_NAME = os.getenv('old_billing_db_name')
 OLD_DB_HOST = os.getenv('old_billing_db_host')
 
+DB_CONNECT_TIMEOUT = int(os.getenv('db_connect_timeout', '3'))
+
 db_config = {
     'user': USER,
     'password': PASS,
     'db': DB_NAME,
     'host': DB_HOST,
     'port': DB_PORT,
+    'connect_timeout': DB_CONNECT_TIMEOUT,
 }
 
 old_db_config = {
@@ -39,7 +51,121 @@ old_db_config = {
     'db': OLD_DB_NAME,
     'host': OLD_DB_HOST,
     'port': DB_PORT,
+    'connect_timeout': DB_CONNECT_TIMEOUT,
+}
+
+# Read replicas (same credentials as the primary); read-only helpers go through read_pool
+REPLICA_HOSTS = {
+    'BGBilling': os.getenv('billing_db_replica_host'),
+    'Felix': os.getenv('old_billing_db_replica_host'),
+}
+REPLICA_PORTS = {
+    'BGBilling': int(os.getenv('billing_db_replica_port', DB_PORT)),
+    'Felix': int(os.getenv('old_billing_db_replica_port', DB_PORT)),
 }
+REPLICA_MAX_LAG = float(os.getenv('replica_max_lag_seconds', '5'))
+REPLICA_CHECK_INTERVAL = 5  # seconds between replication lag checks
+READ_YOUR_WRITES_SECONDS = float(os.getenv('read_your_writes_seconds', '30'))
+
+primary_configs = {'BGBilling': db_config, 'Felix': old_db_config}
+replica_configs = {name: {**primary_configs[name], 'host': host, 'port': REPLICA_PORTS[name]}
+                   for name, host in REPLICA_HOSTS.items() if host}
+
+# Last measured lag per replica; None means unknown, replication stopped or replica unreachable
+replica_state = {name: {'lag': None, 'checked_at': float('-inf')} for name in replica_configs}
+
+# Accounts this process wrote, with the time.time() until which their reads stay on the primary; the
+# app DB's billing_writes table carries the same to the other processes, see mark_written
+recent_writes = {}
+
+
+async def mark_written(account, seconds: float = READ_YOUR_WRITES_SECONDS) -> None:
+    # Read-your-writes: the account's next reads see its own changes even while replicas catch up, and don't
+    # join a read of it already in flight. The marker is shared through the app DB: the write often happens in
+    # another process (the worker crediting a payment) than the subscriber's next read.
+    from db.app_db import set_billing_written
+
+    forget(account)
+    now = time.time()
+    if len(recent_writes) > 10000:
+        for key in [key for key, until in recent_writes.items() if until < now]:
+            del recent_writes[key]
+    until = max(recent_writes.get(str(account), 0), now + seconds)
+    recent_writes[str(account)] = until
+    try:
+        await set_billing_written(account, until)
+    except Exception as e:
+        # The billing write itself went through; other processes may read a lagging replica for a while
+        logger.warning('could not share the billing write of %s: %r', account, e)
+
+
+async def _written_recently(account) -> bool:
+    from db.app_db import get_billing_written_until
+
+    now = time.time()
+    if recent_writes.get(str(account), 0) > now:
+        return True
+    try:
+        return await get_billing_written_until(account) > now
+    except Exception as e:
+        # Unknown: the primary is always safe to read
+        logger.warning('could not look up billing writes of %s, reading from primary: %r', account, e)
+        return True
+
+
+async def _check_replica(database: str) -> None:
+    state = replica_state[database]
+    state['checked_at'] = time.monotonic()
+    try:
+        async with aiomysql.connect(**replica_configs[database]) as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cur:
+                try:
+                    await cur.execute("SHOW REPLICA STATUS")
+                except aiomysql.ProgrammingError:
+                    # MySQL before 8.0.22 and MariaDB
+                    await cur.execute("SHOW SLAVE STATUS")
+                status = await cur.fetchone()
+    except Exception as e:
+        logger.warning('%s replica check failed: %s', database, e)
+        status = None
+    lag = None
+    if status:
+        lag = status.get('Seconds_Behind_Source', status.get('Seconds_Behind_Master'))
+    state['lag'] = lag
+    REPLICA_LAG.labels(database).set(-1 if lag is None else lag)
+
+
+async def _use_replica(database: str, account) -> bool:
+    if database not in replica_configs:
+        return False
+    state = replica_state[database]
+    if time.monotonic() - state['checked_at'] > REPLICA_CHECK_INTERVAL:
+        await _check_replica(database)
+    if state['lag'] is None or state['lag'] > REPLICA_MAX_LAG:
+        return False
+    return account is None or not await _written_recently(account)
+
+
+@asynccontextmanager
+async def read_pool(database: str, account=None):
+    # Pool for a read-only helper: the replica while it is reachable, within REPLICA_MAX_LAG and the account
+    # hasn't written recently; the primary otherwise
+    pool = None
+    if await _use_replica(database, account):
+        try:
+            pool = await aiomysql.create_pool(**replica_configs[database])
+            DB_READS.labels(database, 'replica').inc()
+        except Exception as e:
+            logger.warning('%s replica unavailable, reading from primary: %s', database, e)
+            replica_state[database]['lag'] = None
+    if pool is None:
+        pool = await aiomysql.create_pool(**primary_configs[database])
+        DB_READS.labels(database, 'primary').inc()
+    try:
+        yield pool
+    finally:
+        pool.close()
+        await pool.wait_closed()
 
 
 def penultimate_date_of_current_month() -> str:
@@ -68,12 +194,16 @@ def convert_to_dict(tuples: tuple[tuple], key_prefix: str) -> dict:
     return result
 
 
+@single_flight()
+@limited('BGBilling')
+@resilient('BGBilling')
+@observe_query('BGBilling')
 async def get_user_new(login: str):
     query = 'SELECT title, pswd FROM contract WHERE title = %s'
     async with aiomysql.create_pool(**db_config) as pool:
         async with pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(query, (login,))
+                await execute(cur, query, (login,))
                 result = await cur.fetchone()  # is not None
                 if result is not None:
                     return {'username': result[0], 'password': result[1]}
@@ -81,12 +211,16 @@ async def get_user_new(login: str):
                     return False
 
 
+@single_flight()
+@limited('Felix')
+@resilient('Felix')
+@observe_query('Felix')
 async def get_user_old(login: str | int):
     query = 'SELECT login, passwd1 FROM account WHERE login = %s'
     async with aiomysql.create_pool(**old_db_config) as pool:
         async with pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(query, (login,))
+                await execute(cur, query, (login,))
                 result = await cur.fetchone()  # is not None
                 if result is not None:
                     return {'username': result[0], 'password': result[1]}
@@ -104,18 +238,26 @@ async def get_user(account):
     return user
 
 
+@single_flight()
+@limited('BGBilling')
+@resilient('BGBilling', stale=True)
+@observe_query('BGBilling')
 async def check_support(login: str) -> bool:
     query = 'SELECT comment FROM contract WHERE title = %s'
-    async with aiomysql.create_pool(**db_config) as pool:
+    async with read_pool('BGBilling', login) as pool:
         async with pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(query, (login,))
+                await execute(cur, query, (login,))
                 result = await cur.fetchone()
                 if result and result[0] == 'support':
                     return True
                 return False
 
 
+@single_flight()
+@limited('BGBilling')
+@resilient('BGBilling', stale=True)
+@observe_query('BGBilling')
 async def get_payments_new(account):
     def date_90_days_ago():
         # Get the current date
@@ -130,17 +272,21 @@ async def get_payments_new(account):
     AND dt > %s
     ORDER BY dt DESC"""
 
-    async with aiomysql.create_pool(**db_config) as pool:
+    async with read_pool('BGBilling', account) as pool:
         async with pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(payments_sql, (account, date_90_days_ago()))
+                await execute(cur, payments_sql, (account, date_90_days_ago()))
                 payments = await cur.fetchall()
                 history = [{'id': pay[0],
                             'date': pay[2].strftime("%d.%m.%y %H:%M:%S"),
-                            'summ': float(pay[1])} for pay in payments if payments]
+                            'summ': int(pay[1])} for pay in payments if payments]
                 return history
 
 
+@single_flight()
+@limited('Felix')
+@resilient('Felix', stale=True)
+@observe_query('Felix')
 async def get_payments_old(account):
     def date_90_days_ago():
         # Get the current date
@@ -155,14 +301,14 @@ async def get_payments_old(account):
     AND date_add > %s
     ORDER BY date_add DESC"""
 
-    async with aiomysql.create_pool(**old_db_config) as pool:
+    async with read_pool('Felix', account) as pool:
         async with pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(payments_sql, (account, date_90_days_ago()))
+                await execute(cur, payments_sql, (account, date_90_days_ago()))
                 payments = await cur.fetchall()
                 history = [{'id': pay[0],
                             'date': datetime.fromtimestamp(pay[2]).strftime("%d.%m.%Y %H:%M:%S"),
-                            'summ': float(pay[1])} for pay in payments if payments]
+                            'summ': int(pay[1])} for pay in payments if payments]
                 return history
 
 
@@ -176,6 +322,9 @@ async def get_payments(account):
     return payments
 
 
+@limited('BGBilling')
+@resilient('BGBilling')
+@observe_query('BGBilling')
 async def check_login(login):
     # SQL query
     sql = """
@@ -185,7 +334,7 @@ async def check_login(login):
     async with aiomysql.create_pool(**db_config) as pool:
         async with pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(sql, (login,))
+                await execute(cur, sql, (login,))
                 result = await cur.fetchone()
                 if result is not None:
                     return True
@@ -193,6 +342,9 @@ async def check_login(login):
                     return False
 
 
+@limited('BGBilling')
+@resilient('BGBilling')
+@observe_query('BGBilling')
 async def check_password(password):
     # SQL query
     sql = """
@@ -202,7 +354,7 @@ async def check_password(password):
     async with aiomysql.create_pool(**db_config) as pool:
         async with pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(sql, (password,))
+                await execute(cur, sql, (password,))
                 result = await cur.fetchone()
                 if result is not None:
                     return True
@@ -210,6 +362,9 @@ async def check_password(password):
                     return False
 
 
+@limited('BGBilling')
+@resilient('BGBilling')
+@observe_query('BGBilling')
 async def update_password_new(account, new_password):
     # SQL query
     query = """
@@ -218,10 +373,14 @@ async def update_password_new(account, new_password):
     async with aiomysql.create_pool(**db_config) as pool:
         async with pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(query, (new_password, account))
+                await execute(cur, query, (new_password, account))
                 await conn.commit()
+    await mark_written(account)
 
 
+@limited('Felix')
+@resilient('Felix')
+@observe_query('Felix')
 async def update_password_old(account, new_password):
     # SQL query
     query = """
@@ -230,8 +389,9 @@ async def update_password_old(account, new_password):
     async with aiomysql.create_pool(**old_db_config) as pool:
         async with pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(query, (new_password, account))
+                await execute(cur, query, (new_password, account))
                 await conn.commit()
+    await mark_written(account)
 
 
 async def update_password(account, new_password):
@@ -242,27 +402,33 @@ async def update_password(account, new_password):
             await update_password_new(account, new_password)
 
 
+@limited('Felix')
+@resilient('Felix')
+@observe_query('Felix')
 async def get_user_group_id_old(accounts: list) -> dict[Any, list[Any]]:
     # SQL query
     sql_query = """SELECT acc_group_id, login FROM account WHERE login IN %s"""
 
-    async with aiomysql.create_pool(**old_db_config) as pool:
+    async with read_pool('Felix') as pool:
         async with pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(sql_query, (accounts,))
+                await execute(cur, sql_query, (accounts,))
                 result = await cur.fetchall()
     return convert_to_dict(result, key_prefix='felix-abons-')
 
 
+@limited('BGBilling')
+@resilient('BGBilling')
+@observe_query('BGBilling')
 async def get_user_group_id_new(accounts: list) -> dict[Any, list[Any]]:
     # SQL query
     if accounts:
         sql_query = """SELECT gr, title FROM contract WHERE title IN %s"""
 
-        async with aiomysql.create_pool(**db_config) as pool:
+        async with read_pool('BGBilling') as pool:
             async with pool.acquire() as conn:
                 async with conn.cursor() as cur:
-                    await cur.execute(sql_query, (accounts,))
+                    await execute(cur, sql_query, (accounts,))
                     result = await cur.fetchall()
         return convert_to_dict(result, key_prefix='bgbilling-abons-')
     else:
@@ -276,6 +442,10 @@ async def get_user_group_ids(accounts: dict) -> dict[Any, list[Any]]:
     return merged_dict
 
 
+@single_flight()
+@limited('Felix')
+@resilient('Felix', stale=True)
+@observe_query('Felix')
 async def get_group_id_old(account: str) -> int:
     sql_query = """
     SELECT 
@@ -285,14 +455,18 @@ async def get_group_id_old(account: str) -> int:
     LEFT JOIN
         acc_group ON acc_group.id = account.acc_group_id
     WHERE login = %s"""
-    async with aiomysql.create_pool(**old_db_config) as pool:
+    async with read_pool('Felix', account) as pool:
         async with pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(sql_query, (account,))
+                await execute(cur, sql_query, (account,))
                 result = await cur.fetchone()
                 return result
 
 
+@single_flight()
+@limited('BGBilling')
+@resilient('BGBilling', stale=True)
+@observe_query('BGBilling')
 async def get_group_id_new(account: str) -> int:
     sql_query = """
     SELECT
@@ -301,10 +475,10 @@ async def get_group_id_new(account: str) -> int:
     FROM contract
     LEFT JOIN contract_group ON contract_group.id = contract.gr
     WHERE contract.title = %s"""
-    async with aiomysql.create_pool(**db_config) as pool:
+    async with read_pool('BGBilling', account) as pool:
         async with pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(sql_query, (account,))
+                await execute(cur, sql_query, (account,))
                 result = await cur.fetchone()
                 return result
 
@@ -317,6 +491,10 @@ async def get_group_id(account: str) -> int:
             return await get_group_id_new(account)
 
 
+@single_flight()
+@limited('BGBilling')
+@resilient('BGBilling', stale=True)
+@observe_query('BGBilling')
 async def get_user_data_new(account):
     rate_cost_int = {
         'Минимальный-15': 3550,
@@ -378,10 +556,10 @@ async def get_user_data_new(account):
                         min_pay=0.00,
                         pay_day='')
 
-    async with aiomysql.create_pool(**db_config) as pool:
+    async with read_pool('BGBilling', account) as pool:
         async with pool.acquire() as conn:
             async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(user_sql, (account,))
+                await execute(cur, user_sql, (account,))
                 user_data = await cur.fetchone()
                 if user_data:
                     rate_name = user_data['rate_name'] if user_data['rate_name'] else ''
@@ -398,6 +576,10 @@ async def get_user_data_new(account):
                                     pay_day=penultimate_date_of_current_month())
 
 
+@single_flight()
+@limited('Felix')
+@resilient('Felix', stale=True)
+@observe_query('Felix')
 async def get_user_data_old(account: str | int):
     user_query = """
     SELECT
@@ -425,10 +607,10 @@ async def get_user_data_old(account: str | int):
         account.login = %s
     LIMIT 1;
     """
-    async with aiomysql.create_pool(**old_db_config) as pool:
+    async with read_pool('Felix', account) as pool:
         async with pool.acquire() as conn:
             async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(user_query, (account,))
+                await execute(cur, user_query, (account,))
                 user_data = await cur.fetchone()
                 if user_data:
                     rate_cost = user_data['rate_cost'] if user_data['rate_cost'] else 0.00
@@ -445,6 +627,34 @@ async def get_user_data_old(account: str | int):
                                     pay_day=next_pay_day(user_data['pay_day']))
 
 
+@limited('Felix')
+@resilient('Felix')
+@observe_query('Felix')
+async def get_pay_days_old(accounts: list) -> dict:
+    # Next pay date of many accounts at once, same rule as get_user_data_old's pay_day
+    query = """
+    SELECT
+        account.login,
+        (
+            SELECT date_close
+            FROM payment
+            WHERE account_id = account.id
+            AND type != 2
+            ORDER BY date_close DESC
+            LIMIT 1
+        ) AS pay_day
+    FROM account
+    WHERE account.login IN %s"""
+    if not accounts:
+        return {}
+    async with read_pool('Felix') as pool:
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await execute(cur, query, (tuple(accounts),))
+                result = await cur.fetchall()
+    return {login: datetime.fromtimestamp(pay_day).date() for login, pay_day in result if pay_day}
+
+
 async def get_user_data(account):
     user = UserData
     match len(account):
@@ -455,38 +665,48 @@ async def get_user_data(account):
     return user
 
 
+@limited('Felix')
+@resilient('Felix')
+@observe_query('Felix')
 async def update_user_balance_old(account: str | int, payment_amount: float, order_id: str | int) -> None:
-    transaction_query = """
-    START TRANSACTION;
-        UPDATE account
-        SET balance = balance + %s
-        WHERE login = %s;
-
-        INSERT INTO deposit
-        (account_id, deposit_type_id, sum, date_add, added_by, ext_id, comment)
-        VALUES (
-            (SELECT id FROM account WHERE login = %s),
-            -9,
-            %s,
-            %s,
-            -1,
-            %s,
-            %s
-        );
-    """
-
+    # Credit the payment and record it as a deposit in one transaction. Idempotent per order (the deposit's
+    # ext_id): reconcile_payments retries orders whose credit failed, and one that did commit is not credited again.
     async with aiomysql.create_pool(**old_db_config) as pool:
         async with pool.acquire() as conn:
+            await conn.begin()
             try:
-                async with conn.cursor(aiomysql.DictCursor) as cur:
-                    await cur.execute(transaction_query, (
-                        payment_amount, account, account, payment_amount, datetime.now().timestamp(), order_id,
-                        'mobile app payment'))
-            except Exception as e:
-                await conn.rollback()  # Rollback the transaction on error
-                raise e
+                async with conn.cursor() as cur:
+                    # The account row lock also serializes concurrent credits of the same order
+                    await execute(cur, "SELECT id FROM account WHERE login = %s FOR UPDATE", (account,))
+                    row = await cur.fetchone()
+                    if row is None:
+                        raise LookupError(f'account {account} not found')
+                    account_id = row[0]
+                    await execute(cur, "SELECT id FROM deposit WHERE account_id = %s AND ext_id = %s",
+                                  (account_id, order_id))
+                    if await cur.fetchone() is None:
+                        await execute(cur, "UPDATE account SET balance = balance + %s WHERE id = %s",
+                                      (payment_amount, account_id))
+                        await execute(
+                            cur,
+                            """
+                            INSERT INTO deposit
+                            (account_id, deposit_type_id, sum, date_add, added_by, ext_id, comment)
+                            VALUES (%s, -9, %s, %s, -1, %s, %s)
+                            """,
+                            (account_id, payment_amount, datetime.now().timestamp(), order_id, 'mobile app payment')
+                        )
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+    await mark_written(account)
 
 
+@single_flight()
+@limited('Felix')
+@resilient('Felix', stale=True)
+@observe_query('Felix')
 async def get_user_location_old(account):
     location_query = """
     SELECT
@@ -499,14 +719,18 @@ async def get_user_location_old(account):
         account.login = %s
     LIMIT 1;
     """
-    async with aiomysql.create_pool(**old_db_config) as pool:
+    async with read_pool('Felix', account) as pool:
         async with pool.acquire() as conn:
             async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(location_query, (account,))
+                await execute(cur, location_query, (account,))
                 location = await cur.fetchone()
                 return location
 
 
+@single_flight()
+@limited('BGBilling')
+@resilient('BGBilling', stale=True)
+@observe_query('BGBilling')
 async def get_user_location_new(account):
     location_query = """
         SELECT 
@@ -518,10 +742,10 @@ async def get_user_location_new(account):
             c.title = %s
         LIMIT 1;
         """
-    async with aiomysql.create_pool(**db_config) as pool:
+    async with read_pool('BGBilling', account) as pool:
         async with pool.acquire() as conn:
             async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(location_query, (account,))
+                await execute(cur, location_query, (account,))
                 location = await cur.fetchone()
                 return location
 
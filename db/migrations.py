@@ -0,0 +1,426 @@
+import asyncio
+import sys
+
+import aiomysql
+
+from db.app_db import app_db_config, APP_DB_NAME, storage
+from db.query_stats import execute
+
+# Fill rooms from existing messages: latest message of every room (archived ones included, with how far their
+# history was archived), then the user messages since the last operator reply, which is what add_message counts
+# as unread
+ROOMS_BACKFILL = [
+    "INSERT INTO rooms (room_id, last_message_id, archived_upto_id) "
+    "SELECT * FROM (SELECT room_id, MAX(id) AS last_id, MAX(id) AS archived_id FROM messages_archive "
+    "GROUP BY room_id) AS latest "
+    "ON DUPLICATE KEY UPDATE last_message_id = GREATEST(last_message_id, last_id), archived_upto_id = archived_id",
+
+    "INSERT INTO rooms (room_id, last_message_id) "
+    "SELECT * FROM (SELECT room_id, MAX(id) AS last_id FROM messages GROUP BY room_id) AS latest "
+    "ON DUPLICATE KEY UPDATE last_message_id = GREATEST(last_message_id, last_id)",
+
+    "UPDATE rooms r JOIN messages_archive m ON m.id = r.last_message_id "
+    "SET r.last_role = m.role, r.last_message = m.message, r.last_type_tag = m.type_tag, "
+    "r.last_created_at = m.created_at",
+
+    "UPDATE rooms r JOIN messages m ON m.id = r.last_message_id "
+    "SET r.last_role = m.role, r.last_message = m.message, r.last_type_tag = m.type_tag, "
+    "r.last_created_at = m.created_at",
+
+    "UPDATE rooms r JOIN ("
+    "SELECT m.room_id, SUM(m.role <> 'support') AS unread, "
+    "MAX(m.type_tag = 'autoResponseRequiresAction') AS requires_action "
+    "FROM messages m LEFT JOIN ("
+    "SELECT room_id, MAX(id) AS answered_id FROM messages "
+    "WHERE role = 'support' AND type_tag IS NULL GROUP BY room_id"
+    ") answered ON answered.room_id = m.room_id "
+    "WHERE m.id > COALESCE(answered.answered_id, 0) GROUP BY m.room_id"
+    ") pending ON pending.room_id = r.room_id "
+    "SET r.unread = pending.unread, r.awaiting_reply = pending.unread > 0, "
+    "r.requires_action = COALESCE(pending.requires_action, 0)",
+]
+
+# Versioned schema of the app DB. Each migration runs once and is recorded in schema_migrations;
+# append new ones at the end and never edit an applied one. MySQL commits DDL implicitly, so keep
+# one ALTER per migration: a failed migration then leaves nothing half-applied to trip the re-run.
+MIGRATIONS = [
+    (1, 'baseline tables', [
+        "CREATE TABLE IF NOT EXISTS refresh_tokens ("
+        "id INT AUTO_INCREMENT PRIMARY KEY, "
+        "user VARCHAR(255) UNIQUE, "
+        "password TEXT, "
+        "token VARCHAR(255) UNIQUE)",
+
+        "CREATE TABLE IF NOT EXISTS autopayments ("
+        "id INT AUTO_INCREMENT PRIMARY KEY, "
+        "user VARCHAR(255) UNIQUE, "
+        "bindingId TEXT, "
+        "payment_summ INT, "
+        "ip TEXT, "
+        "updated DATETIME, "
+        "FOREIGN KEY(user) REFERENCES refresh_tokens(user))",
+
+        "CREATE TABLE IF NOT EXISTS alerts ("
+        "id INT AUTO_INCREMENT PRIMARY KEY, "
+        "user VARCHAR(255) UNIQUE, "
+        "status INT, "
+        "FOREIGN KEY(user) REFERENCES refresh_tokens(user))",
+
+        "CREATE TABLE IF NOT EXISTS messages ("
+        "id INT AUTO_INCREMENT PRIMARY KEY, "
+        "room_id TEXT, "
+        "role TEXT, "
+        "message TEXT, "
+        "type_tag TEXT, "
+        "created_at INT)",
+
+        "CREATE TABLE IF NOT EXISTS news ("
+        "id INT AUTO_INCREMENT PRIMARY KEY, "
+        "group_id INT, "
+        "location VARCHAR(255) UNIQUE, "
+        "message TEXT)",
+
+        "CREATE TABLE IF NOT EXISTS payment_orders ("
+        "id INT AUTO_INCREMENT PRIMARY KEY, "
+        "order_id VARCHAR(64) UNIQUE, "
+        "user VARCHAR(255), "
+        "autopay TINYINT, "
+        "state VARCHAR(16) DEFAULT 'pending', "
+        "created_at INT, "
+        "INDEX (state))",
+    ]),
+    # Rooms are account numbers; TEXT can't be indexed without a prefix. Copies the table, run off-peak. Checked
+    # first: MODIFY would fail on (or, outside strict mode, truncate) a longer room_id.
+    (2, 'index messages by room', [
+        ("SELECT COALESCE(MAX(CHAR_LENGTH(room_id)), 0) <= 32 FROM messages",
+         'messages.room_id has values longer than 32 characters; fix them before migration 2'),
+        "ALTER TABLE messages MODIFY room_id VARCHAR(32), ADD INDEX idx_messages_room (room_id, id)",
+    ]),
+    # Version 3 is unused: news needs no index besides the UNIQUE one on location, which every news query uses
+    (4, 'index alerts by status', [
+        "ALTER TABLE alerts ADD INDEX idx_alerts_status (status)",
+    ]),
+    # Cold storage for rooms idle for months (tasks.archive_chats); rows keep their ids from messages
+    (5, 'messages archive', [
+        "CREATE TABLE IF NOT EXISTS messages_archive ("
+        "id INT PRIMARY KEY, "
+        "room_id VARCHAR(32), "
+        "role TEXT, "
+        "message TEXT, "
+        "type_tag TEXT, "
+        "created_at INT, "
+        "INDEX idx_messages_archive_room (room_id, id))",
+    ]),
+    # Operator search (search_messages). The first FULLTEXT index rebuilds the table to add FTS_DOC_ID.
+    (6, 'fulltext index on messages', [
+        "ALTER TABLE messages ADD FULLTEXT INDEX ft_messages_message (message)",
+    ]),
+    (7, 'fulltext index on archived messages', [
+        "ALTER TABLE messages_archive ADD FULLTEXT INDEX ft_messages_archive_message (message)",
+    ]),
+    # One row per room with its latest message and counters, kept up to date by add_message (get_rooms)
+    (8, 'rooms', [
+        "CREATE TABLE IF NOT EXISTS rooms ("
+        "room_id VARCHAR(32) PRIMARY KEY, "
+        "last_message_id INT NOT NULL, "
+        "last_role VARCHAR(32), "
+        "last_message TEXT, "
+        "last_type_tag VARCHAR(64), "
+        "last_created_at INT, "
+        "unread INT NOT NULL DEFAULT 0, "
+        "awaiting_reply TINYINT NOT NULL DEFAULT 0, "
+        "requires_action TINYINT NOT NULL DEFAULT 0, "
+        "archived_upto_id INT NULL, "
+        "INDEX idx_rooms_activity (last_message_id), "
+        "INDEX idx_rooms_awaiting (awaiting_reply, last_message_id), "
+        "INDEX idx_rooms_action (requires_action, last_message_id))",
+    ] + ROOMS_BACKFILL),
+    # Next pay date per subscriber for pay_day_push, refreshed from billing by tasks.refresh_pay_days
+    (9, 'pay-day calendar', [
+        "CREATE TABLE IF NOT EXISTS pay_days ("
+        "account VARCHAR(32) PRIMARY KEY, "
+        "next_pay_date DATE, "
+        "updated_at DATETIME NOT NULL, "
+        "INDEX idx_pay_days_date (next_pay_date, account), "
+        "INDEX idx_pay_days_updated (updated_at))",
+    ]),
+    # Last change of each row's message, polled by API processes to evict their news cache (sync_news_cache)
+    (10, 'news change time', [
+        "ALTER TABLE news ADD COLUMN updated_at DATETIME(6) NULL, ADD INDEX idx_news_updated (updated_at)",
+    ]),
+    # Whether the accident push reached the account; check_alerts retries the ones still at 0
+    (11, 'alert push delivery', [
+        "ALTER TABLE alerts ADD COLUMN notified TINYINT NOT NULL DEFAULT 1",
+    ]),
+    # Read-your-writes across processes: billing reads of an account stay on the primary until written_until
+    # (unix time), whichever process wrote (db.billing_db.mark_written)
+    (12, 'billing writes', [
+        "CREATE TABLE IF NOT EXISTS billing_writes ("
+        "account VARCHAR(32) PRIMARY KEY, "
+        "written_until DOUBLE NOT NULL)",
+    ]),
+]
+
+# The same schema for app_db_engine=sqlite, as of MySQL migration 9. A new migration gets the same version in
+# both lists. FTS5 tables stand in for the FULLTEXT indexes; triggers keep them in sync with their tables.
+SQLITE_MIGRATIONS = [
+    (9, 'baseline schema', [
+        "CREATE TABLE IF NOT EXISTS refresh_tokens ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "user TEXT UNIQUE, "
+        "password TEXT, "
+        "token TEXT UNIQUE)",
+
+        "CREATE TABLE IF NOT EXISTS autopayments ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "user TEXT UNIQUE REFERENCES refresh_tokens(user), "
+        "bindingId TEXT, "
+        "payment_summ INTEGER, "
+        "ip TEXT, "
+        "updated TIMESTAMP)",
+
+        "CREATE TABLE IF NOT EXISTS alerts ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "user TEXT UNIQUE REFERENCES refresh_tokens(user), "
+        "status INTEGER)",
+        "CREATE INDEX IF NOT EXISTS idx_alerts_status ON alerts (status)",
+
+        # AUTOINCREMENT: ids of archived messages must never be handed out again
+        "CREATE TABLE IF NOT EXISTS messages ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "room_id TEXT, "
+        "role TEXT, "
+        "message TEXT, "
+        "type_tag TEXT, "
+        "created_at INTEGER)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_room ON messages (room_id, id)",
+
+        "CREATE TABLE IF NOT EXISTS news ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "group_id INTEGER, "
+        "location TEXT UNIQUE, "
+        "message TEXT)",
+
+        "CREATE TABLE IF NOT EXISTS payment_orders ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "order_id TEXT UNIQUE, "
+        "user TEXT, "
+        "autopay INTEGER, "
+        "state TEXT DEFAULT 'pending', "
+        "created_at INTEGER)",
+        "CREATE INDEX IF NOT EXISTS idx_payment_orders_state ON payment_orders (state)",
+
+        "CREATE TABLE IF NOT EXISTS messages_archive ("
+        "id INTEGER PRIMARY KEY, "
+        "room_id TEXT, "
+        "role TEXT, "
+        "message TEXT, "
+        "type_tag TEXT, "
+        "created_at INTEGER)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_archive_room ON messages_archive (room_id, id)",
+    ] + [statement for table in ('messages', 'messages_archive') for statement in (
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5("
+        f"message, content='{table}', content_rowid='id')",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table} BEGIN "
+        f"INSERT INTO {table}_fts (rowid, message) VALUES (new.id, new.message); END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} BEGIN "
+        f"INSERT INTO {table}_fts ({table}_fts, rowid, message) VALUES ('delete', old.id, old.message); END",
+    )] + [
+        "CREATE TABLE IF NOT EXISTS rooms ("
+        "room_id TEXT PRIMARY KEY, "
+        "last_message_id INTEGER NOT NULL, "
+        "last_role TEXT, "
+        "last_message TEXT, "
+        "last_type_tag TEXT, "
+        "last_created_at INTEGER, "
+        "unread INTEGER NOT NULL DEFAULT 0, "
+        "awaiting_reply INTEGER NOT NULL DEFAULT 0, "
+        "requires_action INTEGER NOT NULL DEFAULT 0, "
+        "archived_upto_id INTEGER)",
+        "CREATE INDEX IF NOT EXISTS idx_rooms_activity ON rooms (last_message_id)",
+        "CREATE INDEX IF NOT EXISTS idx_rooms_awaiting ON rooms (awaiting_reply, last_message_id)",
+        "CREATE INDEX IF NOT EXISTS idx_rooms_action ON rooms (requires_action, last_message_id)",
+
+        "CREATE TABLE IF NOT EXISTS pay_days ("
+        "account TEXT PRIMARY KEY, "
+        "next_pay_date DATE, "
+        "updated_at TIMESTAMP NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS idx_pay_days_date ON pay_days (next_pay_date, account)",
+        "CREATE INDEX IF NOT EXISTS idx_pay_days_updated ON pay_days (updated_at)",
+    ]),
+    (10, 'news change time', [
+        "ALTER TABLE news ADD COLUMN updated_at TIMESTAMP",
+        "CREATE INDEX IF NOT EXISTS idx_news_updated ON news (updated_at)",
+    ]),
+    (11, 'alert push delivery', [
+        "ALTER TABLE alerts ADD COLUMN notified INTEGER NOT NULL DEFAULT 1",
+    ]),
+    (12, 'billing writes', [
+        "CREATE TABLE IF NOT EXISTS billing_writes ("
+        "account TEXT PRIMARY KEY, "
+        "written_until REAL NOT NULL)",
+    ]),
+]
+
+# The queries each index exists for, with sample parameters; `python -m db.migrations explain` checks
+# that MySQL actually picks the index. Keep in sync with the helpers in db/app_db.py.
+INDEXED_QUERIES = [
+    ('idx_messages_room', 'get_messages',
+     "SELECT id, role, message, type_tag, created_at FROM messages WHERE room_id = %s ORDER BY id DESC LIMIT 20",
+     ('10001',)),
+    ('idx_messages_room', 'get_messages (less_id)',
+     "SELECT id, role, message, type_tag, created_at FROM messages WHERE room_id = %s AND id < %s "
+     "ORDER BY id DESC LIMIT 20",
+     ('10001', 1000)),
+    ('idx_messages_archive_room', 'get_messages (archived history)',
+     "SELECT id, role, message, type_tag, created_at FROM messages_archive WHERE room_id = %s AND id < %s "
+     "ORDER BY id DESC LIMIT 20",
+     ('10001', 1000)),
+    ('idx_messages_room', 'get_idle_rooms',
+     "SELECT room_id, MAX(id) FROM messages GROUP BY room_id",
+     ()),
+    ('ft_messages_message', 'search_messages',
+     "SELECT id, room_id, role, message, type_tag, created_at FROM messages "
+     "WHERE MATCH(message) AGAINST (%s IN BOOLEAN MODE) AND id < %s ORDER BY id DESC LIMIT 50",
+     ('+роутер*', 2 ** 31 - 1)),
+    ('ft_messages_archive_message', 'search_messages (archive)',
+     "SELECT id, room_id, role, message, type_tag, created_at FROM messages_archive "
+     "WHERE MATCH(message) AGAINST (%s IN BOOLEAN MODE) AND id < %s ORDER BY id DESC LIMIT 50",
+     ('+роутер*', 2 ** 31 - 1)),
+    ('idx_rooms_activity', 'get_rooms',
+     "SELECT r.room_id FROM rooms r LEFT JOIN alerts a ON a.user = r.room_id "
+     "WHERE r.last_message_id < %s ORDER BY r.last_message_id DESC LIMIT 50",
+     (2 ** 31 - 1,)),
+    ('idx_rooms_awaiting', 'get_rooms (awaiting_reply)',
+     "SELECT r.room_id FROM rooms r LEFT JOIN alerts a ON a.user = r.room_id "
+     "WHERE r.awaiting_reply = 1 ORDER BY r.last_message_id DESC LIMIT 50",
+     ()),
+    ('idx_rooms_action', 'get_rooms (requires_action)',
+     "SELECT r.room_id FROM rooms r LEFT JOIN alerts a ON a.user = r.room_id "
+     "WHERE r.requires_action = 1 ORDER BY r.last_message_id DESC LIMIT 50",
+     ()),
+    ('idx_pay_days_date', 'get_accounts_paying_on',
+     "SELECT account FROM pay_days WHERE next_pay_date = %s AND account > %s ORDER BY account LIMIT 1000",
+     ('2024-06-29', '')),
+    ('idx_pay_days_updated', 'get_stale_pay_days',
+     "SELECT account FROM pay_days WHERE updated_at < %s ORDER BY updated_at LIMIT 5000",
+     ('2024-06-28 10:00:00',)),
+    ('location', 'get_group_news',
+     "SELECT message FROM news WHERE group_id = %s AND location = %s",
+     (1, 'Новосибирск')),
+    ('idx_news_updated', 'sync_news_cache',
+     "SELECT group_id, location, updated_at FROM news WHERE updated_at > %s",
+     ('2024-06-28 10:00:00',)),
+    ('idx_alerts_status', 'load_accident_status / set_accident_status',
+     "SELECT user FROM alerts WHERE status = %s",
+     (1,)),
+    ('state', 'get_open_payment_orders',
+     "SELECT order_id, user, autopay, created_at, state FROM payment_orders WHERE state IN %s",
+     (('pending', 'crediting'),)),
+]
+
+LOCK_NAME = f'{APP_DB_NAME}.schema_migrations'
+LOCK_TIMEOUT = 600  # seconds another process may spend migrating before we give up
+
+
+async def _apply(cur, migrations: list) -> list:
+    applied = []
+    await execute(
+        cur,
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version INT PRIMARY KEY, "
+        "description VARCHAR(255), "
+        "applied_at DATETIME DEFAULT CURRENT_TIMESTAMP)"
+    )
+    await execute(cur, "SELECT version FROM schema_migrations")
+    done = {row[0] for row in await cur.fetchall()}
+    for version, description, statements in migrations:
+        if version in done:
+            continue
+        for statement in statements:
+            if isinstance(statement, tuple):
+                # (query, error): a pre-check whose single value must be true for the migration to go ahead
+                query, error = statement
+                await execute(cur, query)
+                (ok,) = await cur.fetchone()
+                if not ok:
+                    raise RuntimeError(f'migration {version} ({description}): {error}')
+                continue
+            await execute(cur, statement)
+        await execute(
+            cur,
+            "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+            (version, description)
+        )
+        applied.append(version)
+    return applied
+
+
+async def migrate() -> list:
+    # Apply pending migrations; API processes and workers all call this on startup, the named lock
+    # makes the first one migrate while the rest wait and then find nothing to do
+    if storage.dialect == 'sqlite':
+        # SQLite DDL is transactional: one write transaction does for the lock, and a failed migration rolls back
+        async with storage.connection(write=True) as conn:
+            await conn.begin()
+            async with conn.cursor() as cur:
+                applied = await _apply(cur, SQLITE_MIGRATIONS)
+            await conn.commit()
+        return applied
+
+    conn = await aiomysql.connect(**app_db_config, autocommit=True)
+    try:
+        async with conn.cursor() as cur:
+            await execute(cur, "SELECT GET_LOCK(%s, %s)", (LOCK_NAME, LOCK_TIMEOUT))
+            (locked,) = await cur.fetchone()
+            if locked != 1:
+                raise RuntimeError(f'could not take the {LOCK_NAME} lock')
+            try:
+                applied = await _apply(cur, MIGRATIONS)
+            finally:
+                await execute(cur, "SELECT RELEASE_LOCK(%s)", (LOCK_NAME,))
+    finally:
+        conn.close()
+    return applied
+
+
+async def explain_indexes() -> list:
+    # EXPLAIN every query in INDEXED_QUERIES; on near-empty tables MySQL may prefer a scan, so check
+    # against production-sized data
+    report = []
+    conn = await aiomysql.connect(**app_db_config, autocommit=True)
+    try:
+        async with conn.cursor(aiomysql.DictCursor) as cur:
+            for index, helper, query, params in INDEXED_QUERIES:
+                await cur.execute(f"EXPLAIN {query}", params or None)
+                plan = await cur.fetchall()
+                used = [row['key'] for row in plan if row['key']]
+                report.append({
+                    'index': index,
+                    'helper': helper,
+                    'key': ', '.join(used) or None,
+                    'rows': sum(row['rows'] or 0 for row in plan),
+                    'extra': '; '.join(row['Extra'] for row in plan if row['Extra']),
+                    'ok': index in used,
+                })
+    finally:
+        conn.close()
+    return report
+
+
+async def main(command: str):
+    if command == 'explain' and storage.dialect != 'mysql':
+        sys.exit('explain checks MySQL query plans; app_db_engine is not mysql')
+    if command == 'explain':
+        for item in await explain_indexes():
+            mark = 'ok  ' if item['ok'] else 'MISS'
+            print(f"{mark} {item['index']:<26} {item['helper']:<44} key={item['key']} rows={item['rows']} "
+                  f"{item['extra']}")
+    else:
+        applied = await migrate()
+        print(f'applied migrations: {applied}' if applied else 'schema is up to date')
+    await storage.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(sys.argv[1] if len(sys.argv) > 1 else 'migrate'))
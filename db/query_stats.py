@@ -0,0 +1,102 @@
+import hashlib
+import logging
+import os
+import random
+import re
+import time
+from functools import lru_cache
+
+logger = logging.getLogger('slow_query')
+
+SLOW_QUERY_MS = float(os.getenv('slow_query_ms', '200'))
+EXPLAIN_SAMPLE_RATE = float(os.getenv('explain_sample_rate', '0'))  # share of slow SELECTs to EXPLAIN
+
+_WHITESPACE = re.compile(r'\s+')
+_LITERALS = re.compile(r"'(?:[^'\\]|\\.)*'|\b\d+\b")
+
+# fingerprint -> aggregate for every statement executed through this module
+fingerprints = {}
+
+
+@lru_cache(maxsize=1024)
+def fingerprint(query: str) -> tuple[str, str]:
+    normalized = _LITERALS.sub('?', _WHITESPACE.sub(' ', query).strip())
+    return hashlib.md5(normalized.encode('utf-8')).hexdigest()[:12], normalized
+
+
+def redact(params) -> str:
+    # Only parameter types and lengths reach the log, never values (logins, passwords, tokens)
+    if params is None:
+        return '()'
+    if isinstance(params, dict):
+        params = params.values()
+    redacted = []
+    for value in params:
+        if isinstance(value, (list, tuple, set)):
+            redacted.append(f'<{type(value).__name__}:{len(value)}>')
+        elif isinstance(value, str):
+            redacted.append(f'<str:{len(value)}>')
+        else:
+            redacted.append(f'<{type(value).__name__}>')
+    return f"({', '.join(redacted)})"
+
+
+def _record(cur, query: str, params, elapsed: float, rows: int) -> tuple[str, dict]:
+    key, normalized = fingerprint(query)
+    stats = fingerprints.get(key)
+    if stats is None:
+        db = cur.connection.db
+        stats = fingerprints[key] = {
+            'fingerprint': key,
+            'database': db.decode() if isinstance(db, bytes) else db,
+            'query': normalized,
+            'count': 0,
+            'total_ms': 0.0,
+            'max_ms': 0.0,
+            'rows': 0,
+            'slow': 0,
+            'explain': None,
+        }
+    elapsed_ms = elapsed * 1000
+    stats['count'] += 1
+    stats['total_ms'] += elapsed_ms
+    stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+    stats['rows'] += max(rows, 0)
+    if elapsed_ms >= SLOW_QUERY_MS:
+        stats['slow'] += 1
+        logger.warning('slow query %s on %s: %.1f ms, %d rows, params %s: %s',
+                       key, stats['database'], elapsed_ms, rows, redact(params), normalized)
+    return key, stats
+
+
+async def _explain(cur, query: str, params, stats: dict) -> None:
+    try:
+        async with cur.connection.cursor() as explain_cur:
+            await explain_cur.execute(f'EXPLAIN {query}', params)
+            columns = [column[0] for column in explain_cur.description]
+            stats['explain'] = [dict(zip(columns, row)) for row in await explain_cur.fetchall()]
+    except Exception as e:
+        logger.warning('EXPLAIN failed for %s: %s', stats['fingerprint'], e)
+
+
+async def execute(cur, query: str, params=None) -> int:
+    # Drop-in for `await cur.execute(query, params)`; results stay buffered on `cur`
+    start = time.perf_counter()
+    result = await cur.execute(query, params)
+    elapsed = time.perf_counter() - start
+    key, stats = _record(cur, query, params, elapsed, cur.rowcount)
+    if (elapsed * 1000 >= SLOW_QUERY_MS and EXPLAIN_SAMPLE_RATE and random.random() < EXPLAIN_SAMPLE_RATE
+            and query.lstrip().upper().startswith('SELECT')):
+        await _explain(cur, query, params, stats)
+    return result
+
+
+async def executemany(cur, query: str, args) -> int:
+    start = time.perf_counter()
+    result = await cur.executemany(query, args)
+    _record(cur, query, args[0] if args else None, time.perf_counter() - start, cur.rowcount)
+    return result
+
+
+def top_queries(limit: int = 20, order_by: str = 'total_ms') -> list:
+    return sorted(fingerprints.values(), key=lambda stats: stats[order_by], reverse=True)[:limit]
@@ -0,0 +1,209 @@
+import asyncio
+import os
+import re
+import sqlite3
+from contextlib import asynccontextmanager
+from functools import lru_cache
+
+import aiomysql
+
+# Storage engine behind the app-DB helpers (db/app_db.py). app_db_engine=mysql (default) uses the MySQL
+# server from app_db_*; app_db_engine=sqlite keeps the app DB in one local file (app_db_path) in WAL mode,
+# for small regional deployments without a MySQL server and for local runs. Billing stays on MySQL either way.
+APP_DB_ENGINE = os.getenv('app_db_engine', 'mysql').lower()
+SQLITE_PATH = os.getenv('app_db_path', 'app.sqlite3')
+SQLITE_READERS = int(os.getenv('sqlite_readers', '4'))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('sqlite_busy_timeout_ms', '5000'))
+SQLITE_STATEMENT_CACHE = 256  # compiled statements kept per connection
+
+# Helpers are written in MySQL's dialect; these are the constructs they use that SQLite spells differently
+_UPSERT_ALIAS = re.compile(r'\)\s+AS\s+(\w+)\s+ON\s+DUPLICATE\s+KEY\s+UPDATE', re.IGNORECASE)
+_UPSERT = re.compile(r'ON\s+DUPLICATE\s+KEY\s+UPDATE', re.IGNORECASE)
+_FUNCTIONS = {re.compile(r'\bIF\('): 'IIF(', re.compile(r'\bGREATEST\(', re.IGNORECASE): 'MAX('}
+_EXPLAIN = re.compile(r'^\s*EXPLAIN\s+', re.IGNORECASE)
+
+
+@lru_cache(maxsize=1024)
+def sqlite_sql(query: str) -> str:
+    # Translated once per distinct query, so every call hands sqlite3 the same text and hits its statement cache
+    alias = _UPSERT_ALIAS.search(query)
+    if alias:
+        query = _UPSERT_ALIAS.sub(') ON CONFLICT DO UPDATE SET', query)
+        query = re.sub(rf'\b{alias[1]}\.', 'excluded.', query)
+    query = _UPSERT.sub('ON CONFLICT DO UPDATE SET', query)
+    for pattern, replacement in _FUNCTIONS.items():
+        query = pattern.sub(replacement, query)
+    query = _EXPLAIN.sub('EXPLAIN QUERY PLAN ', query)
+    return query.replace('%s', '?')
+
+
+def _bind(query: str, params) -> tuple[str, tuple]:
+    # aiomysql expands a sequence parameter (`IN %s`) into a parenthesised list; do the same with placeholders
+    if not params:
+        return query, ()
+    params = tuple(params)
+    if not any(isinstance(value, (list, tuple, set, frozenset)) for value in params):
+        return query, params
+    parts = query.split('?')
+    sql, flat = [parts[0]], []
+    for value, rest in zip(params, parts[1:]):
+        if isinstance(value, (list, tuple, set, frozenset)):
+            sql.append(f"({', '.join('?' * len(value))})")
+            flat.extend(value)
+        else:
+            sql.append('?')
+            flat.append(value)
+        sql.append(rest)
+    return ''.join(sql), tuple(flat)
+
+
+class MySQLStorage:
+    dialect = 'mysql'
+
+    def __init__(self, config: dict):
+        self.config = config
+
+    @asynccontextmanager
+    async def connection(self, write: bool = False):
+        async with aiomysql.create_pool(**self.config) as pool:
+            async with pool.acquire() as conn:
+                yield conn
+
+    async def close(self) -> None:
+        pass
+
+
+class _SQLiteCursor:
+    # The slice of the aiomysql cursor API the helpers and db.query_stats use
+    def __init__(self, cursor, connection):
+        self._cursor = cursor
+        self.connection = connection
+
+    async def execute(self, query: str, params=None) -> int:
+        await self._cursor.execute(*_bind(sqlite_sql(query), params))
+        return self._cursor.rowcount
+
+    async def executemany(self, query: str, args) -> int:
+        await self._cursor.executemany(sqlite_sql(query), [tuple(row) for row in args])
+        return self._cursor.rowcount
+
+    async def fetchone(self):
+        return await self._cursor.fetchone()
+
+    async def fetchall(self) -> list:
+        return await self._cursor.fetchall()
+
+    @property
+    def rowcount(self) -> int:
+        return self._cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+
+class _SQLiteConnection:
+    def __init__(self, conn, db: str):
+        self._conn = conn
+        self.db = db
+
+    @asynccontextmanager
+    async def cursor(self):
+        async with self._conn.cursor() as cur:
+            yield _SQLiteCursor(cur, self)
+
+    async def begin(self) -> None:
+        await self._conn.execute('BEGIN IMMEDIATE')
+
+    async def commit(self) -> None:
+        await self._conn.commit()
+
+    async def rollback(self) -> None:
+        await self._conn.rollback()
+
+
+class SQLiteStorage:
+    # One writer connection shared behind a lock (SQLite runs one write transaction at a time anyway) and up
+    # to `readers` read-only connections, which WAL lets read alongside the writer. Connections live for the
+    # life of the process, so sqlite3's per-connection statement cache keeps the helpers' queries prepared.
+    dialect = 'sqlite'
+
+    def __init__(self, path: str, readers: int):
+        self.path = path
+        self.readers = readers
+        self.db = os.path.basename(path)
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+        self._idle = asyncio.Queue()
+        self._all_readers = []
+
+    async def _connect(self, read_only: bool):
+        # Imported on first use, like aiohttp in resilience.client_session: MySQL deployments never load it
+        import aiosqlite
+
+        if read_only:
+            conn = await aiosqlite.connect(f'file:{self.path}?mode=ro', uri=True, detect_types=sqlite3.PARSE_DECLTYPES,
+                                           cached_statements=SQLITE_STATEMENT_CACHE)
+        else:
+            # Implicit transactions start with BEGIN IMMEDIATE: take the write lock up front instead of
+            # upgrading a read lock mid-transaction, which fails outright when another process writes
+            conn = await aiosqlite.connect(self.path, isolation_level='IMMEDIATE',
+                                           detect_types=sqlite3.PARSE_DECLTYPES,
+                                           cached_statements=SQLITE_STATEMENT_CACHE)
+            await conn.execute('PRAGMA journal_mode = WAL')
+            await conn.execute('PRAGMA synchronous = NORMAL')
+        await conn.execute(f'PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}')
+        return conn
+
+    async def _reader(self):
+        if self._idle.empty() and len(self._all_readers) < self.readers:
+            # Readers open the file read-only, so the writer has to have created it (migrate() does on startup)
+            if self._writer is None:
+                async with self._write_lock:
+                    if self._writer is None:
+                        self._writer = await self._connect(read_only=False)
+            conn = await self._connect(read_only=True)
+            self._all_readers.append(conn)
+            return conn
+        return await self._idle.get()
+
+    @asynccontextmanager
+    async def connection(self, write: bool = False):
+        if write:
+            async with self._write_lock:
+                if self._writer is None:
+                    self._writer = await self._connect(read_only=False)
+                try:
+                    yield _SQLiteConnection(self._writer, self.db)
+                finally:
+                    # A helper that raised before commit() must not leave its writes to the next one
+                    if self._writer.in_transaction:
+                        await self._writer.rollback()
+        else:
+            conn = await self._reader()
+            try:
+                yield _SQLiteConnection(conn, self.db)
+            finally:
+                self._idle.put_nowait(conn)
+
+    async def close(self) -> None:
+        # aiosqlite runs each connection on its own thread; close them so the process can exit
+        for conn in self._all_readers:
+            await conn.close()
+        self._all_readers.clear()
+        self._idle = asyncio.Queue()
+        if self._writer is not None:
+            await self._writer.close()
+            self._writer = None
+
+
+def open_storage(mysql_config: dict):
+    if APP_DB_ENGINE == 'sqlite':
+        return SQLiteStorage(SQLITE_PATH, SQLITE_READERS)
+    if APP_DB_ENGINE == 'mysql':
+        return MySQLStorage(mysql_config)
+    raise ValueError(f'unknown app_db_engine {APP_DB_ENGINE!r}, expected mysql or sqlite')
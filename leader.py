@@ -0,0 +1,123 @@
+import asyncio
+import fcntl
+import logging
+import os
+import socket
+from functools import wraps
+
+import aiomysql
+
+from db.app_db import app_db_config, APP_DB_NAME, storage
+from db.query_stats import execute
+from db.storage import SQLITE_PATH
+
+logger = logging.getLogger('leader')
+
+# Named MySQL lock held by the worker that runs the scheduled jobs. GET_LOCK is owned by a
+# connection, so if the leader dies its connection drops, the lock is released and the next
+# campaign round on another worker takes over.
+LOCK_NAME = f'{APP_DB_NAME}.scheduler_leader'
+CAMPAIGN_INTERVAL = int(os.getenv('leader_campaign_seconds', '15'))
+WORKER_ID = f'{socket.gethostname()}:{os.getpid()}'
+
+leader_state = {'connection': None}
+# aiomysql connections take one query at a time; campaign rounds and job checks share the leader's
+_connection_lock = asyncio.Lock()
+
+
+def is_leader() -> bool:
+    return leader_state['connection'] is not None
+
+
+async def _step_down():
+    conn = leader_state['connection']
+    leader_state['connection'] = None
+    if conn is not None:
+        conn.close()
+        logger.warning('worker %s lost scheduler leadership', WORKER_ID)
+
+
+def _campaign_file() -> bool:
+    # app_db_engine=sqlite means every worker shares the database file on one host: an exclusive flock next
+    # to it stands in for GET_LOCK, and the OS releases it when the leader's process dies
+    if is_leader():
+        return True
+    lock_file = open(f'{SQLITE_PATH}.leader', 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    leader_state['connection'] = lock_file
+    logger.warning('worker %s is now the scheduler leader', WORKER_ID)
+    return True
+
+
+async def confirm_leader() -> bool:
+    # Ask MySQL whether the lock is still held by our connection, rather than trusting the last campaign round
+    # (up to CAMPAIGN_INTERVAL old): if the connection dropped meanwhile, another worker may already lead
+    conn = leader_state['connection']
+    if conn is None or storage.dialect == 'sqlite':
+        # A held flock can't be taken over while its file stays open
+        return is_leader()
+    try:
+        async with _connection_lock:
+            async with conn.cursor() as cur:
+                await execute(cur, "SELECT IS_USED_LOCK(%s) = CONNECTION_ID()", (LOCK_NAME,))
+                (still_owner,) = await cur.fetchone()
+    except Exception as e:
+        logger.warning('leader check failed on %s: %s', WORKER_ID, e)
+        still_owner = False
+    if not still_owner and leader_state['connection'] is conn:
+        await _step_down()
+    return is_leader()
+
+
+async def campaign() -> bool:
+    # One election round: confirm the lock is still ours, or try to take it without waiting
+    if storage.dialect == 'sqlite':
+        return _campaign_file()
+    if leader_state['connection'] is not None:
+        return await confirm_leader()
+    conn = None
+    try:
+        conn = await aiomysql.connect(**app_db_config, autocommit=True)
+        async with conn.cursor() as cur:
+            await execute(cur, "SELECT GET_LOCK(%s, 0)", (LOCK_NAME,))
+            (acquired,) = await cur.fetchone()
+        if acquired == 1:
+            leader_state['connection'] = conn
+            logger.warning('worker %s is now the scheduler leader', WORKER_ID)
+        else:
+            conn.close()
+    except Exception as e:
+        logger.warning('leader campaign failed on %s: %s', WORKER_ID, e)
+        if conn is not None and conn is not leader_state['connection']:
+            conn.close()
+        await _step_down()
+    return is_leader()
+
+
+async def resign() -> None:
+    conn = leader_state['connection']
+    if conn is None:
+        return
+    if storage.dialect == 'sqlite':
+        await _step_down()
+        return
+    try:
+        async with _connection_lock:
+            async with conn.cursor() as cur:
+                await execute(cur, "SELECT RELEASE_LOCK(%s)", (LOCK_NAME,))
+    finally:
+        await _step_down()
+
+
+def leader_only(job):
+    # Wrap a scheduled job so it runs only on the worker holding the leader lock, confirmed right before the run
+    @wraps(job)
+    async def wrapper(*args, **kwargs):
+        if is_leader() and await confirm_leader():
+            return await job(*args, **kwargs)
+
+    return wrapper
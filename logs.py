@@ -0,0 +1,113 @@
+import atexit
+import contextvars
+import datetime
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import uuid
+from logging.handlers import QueueHandler, QueueListener
+
+import orjson
+from fastapi import Request
+
+from metrics import LOG_RECORDS_DROPPED
+
+# Structured JSON logs written by a background thread: the event loop only drops records into a bounded
+# queue. Pass fields with extra={...}; they are redacted before being written. High-volume events can set
+# extra={'sample_rate': LOG_SAMPLE_RATE} to keep only that share of them.
+LOG_LEVEL = os.getenv('log_level', 'INFO').upper()
+LOG_SAMPLE_RATE = float(os.getenv('log_sample_rate', '0.1'))
+LOG_QUEUE_SIZE = 10000
+
+REDACTED = '***'
+REDACTED_KEYS = {'username', 'password', 'pswd', 'passwd1', 'token', 'access_token', 'refresh_token',
+                 'authorization', 'bindingid', 'push_api_key', 'zabbix_token'}
+_SECRET_IN_TEXT = re.compile(r'(?i)\b(userName|password|token|bindingId)=([^&\s"]+)')
+
+# Correlation id of the API request being served, None outside requests
+request_id = contextvars.ContextVar('request_id', default=None)
+
+_RECORD_FIELDS = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime'}
+
+log_state = {'listener': None}
+
+
+def redact(value):
+    if isinstance(value, dict):
+        return {key: REDACTED if str(key).lower() in REDACTED_KEYS else redact(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    if isinstance(value, str):
+        return _SECRET_IN_TEXT.sub(rf'\1={REDACTED}', value)
+    return value
+
+
+class JsonFormatter(logging.Formatter):
+    # Runs on the writer thread
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': redact(record.getMessage()),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_FIELDS and key != 'sample_rate':
+                entry[key] = redact(value)
+        return orjson.dumps(entry, default=str).decode('utf-8')
+
+
+class _AsyncQueueHandler(QueueHandler):
+    # Never blocks the caller: a full queue drops the record and counts it
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = super().prepare(record)
+        record.request_id = getattr(record, 'request_id', None) or request_id.get()
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+
+def _sampled(record: logging.LogRecord) -> bool:
+    rate = getattr(record, 'sample_rate', None)
+    return rate is None or random.random() < rate
+
+
+def setup_logging() -> None:
+    # Route the root logger through the queue; safe to call more than once
+    if log_state['listener'] is not None:
+        return
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    writer = logging.StreamHandler(sys.stdout)
+    writer.setFormatter(JsonFormatter())
+    listener = QueueListener(log_queue, writer, respect_handler_level=True)
+
+    handler = _AsyncQueueHandler(log_queue)
+    handler.addFilter(_sampled)
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+
+    listener.start()
+    log_state['listener'] = listener
+    atexit.register(listener.stop)
+
+
+async def request_id_middleware(request: Request, call_next):
+    # Reuse the caller's X-Request-ID (e.g. from the reverse proxy) or make one; echoed back on the response
+    rid = request.headers.get('x-request-id') or uuid.uuid4().hex
+    token = request_id.set(rid)
+    try:
+        response = await call_next(request)
+    finally:
+        request_id.reset(token)
+    response.headers['X-Request-ID'] = rid
+    return response
@@ -0,0 +1,127 @@
+import os
+import time
+from contextlib import asynccontextmanager
+from functools import wraps
+
+from fastapi import Request, Response
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, \
+    generate_latest, multiprocess
+
+ROW_BUCKETS = (0, 1, 5, 10, 20, 50, 100, 500, 1000, 5000, 10000)
+
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'Latency of API requests',
+                            ['method', 'route', 'status'])
+REQUESTS_IN_FLIGHT = Gauge('http_requests_in_flight', 'API requests being served',
+                           ['method'], multiprocess_mode='livesum')
+
+QUERY_LATENCY = Histogram('db_query_duration_seconds', 'Latency of database helpers', ['database', 'function'])
+QUERY_ROWS = Histogram('db_query_rows', 'Rows returned by database helpers', ['database', 'function'],
+                       buckets=ROW_BUCKETS)
+QUERY_ERRORS = Counter('db_query_errors_total', 'Database helpers that raised', ['database', 'function'])
+QUERIES_IN_FLIGHT = Gauge('db_queries_in_flight', 'Database helpers running', ['database'],
+                          multiprocess_mode='livesum')
+DB_READS = Counter('db_reads_total', 'Read-only billing helpers by the server they were routed to',
+                   ['database', 'target'])
+REPLICA_LAG = Gauge('db_replica_lag_seconds', 'Last measured replication lag (-1 when unknown or stopped)',
+                    ['database'], multiprocess_mode='max')
+
+UPSTREAM_LATENCY = Histogram('upstream_request_duration_seconds', 'Latency of outbound calls',
+                             ['upstream', 'method'])
+UPSTREAM_ERRORS = Counter('upstream_request_errors_total', 'Outbound calls that raised', ['upstream', 'method'])
+UPSTREAMS_IN_FLIGHT = Gauge('upstream_requests_in_flight', 'Outbound calls in progress', ['upstream'],
+                            multiprocess_mode='livesum')
+
+DEPENDENCY_ACTIVE = Gauge('dependency_active', 'Admitted calls per dependency', ['dependency'],
+                          multiprocess_mode='livesum')
+DEPENDENCY_QUEUE = Gauge('dependency_queue_depth', 'Calls waiting for a dependency slot', ['dependency'],
+                         multiprocess_mode='livesum')
+DEPENDENCY_SHED = Counter('dependency_shed_total', 'Calls rejected because the dependency queue was full',
+                          ['dependency'])
+SINGLEFLIGHT_CALLS = Counter('singleflight_calls_total',
+                             'Calls of single-flight helpers, executed or coalesced into an identical call in flight',
+                             ['function', 'result'])
+LOG_RECORDS_DROPPED = Counter('log_records_dropped_total', 'Log records dropped because the log queue was full')
+BREAKER_STATE = Gauge('circuit_breaker_state', 'Circuit state per dependency (0 closed, 1 half-open, 2 open)',
+                      ['dependency'], multiprocess_mode='max')
+
+
+def _row_count(result) -> int:
+    # Helpers return rows, dicts of row lists ({'messages': [...]}), a single row or nothing
+    if result is None or result is False:
+        return 0
+    if isinstance(result, (list, tuple, set, frozenset)):
+        return len(result)
+    if isinstance(result, dict):
+        lists = [value for value in result.values() if isinstance(value, list)]
+        return sum(len(value) for value in lists) if lists else 1
+    return 1
+
+
+def observe_query(database: str):
+    # Decorator for db helpers: latency, returned rows, errors and in-flight count per database
+    def decorator(func):
+        name = func.__name__
+        latency = QUERY_LATENCY.labels(database, name)
+        rows = QUERY_ROWS.labels(database, name)
+        errors = QUERY_ERRORS.labels(database, name)
+        in_flight = QUERIES_IN_FLIGHT.labels(database)
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            in_flight.inc()
+            start = time.perf_counter()
+            try:
+                result = await func(*args, **kwargs)
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                latency.observe(time.perf_counter() - start)
+                in_flight.dec()
+            rows.observe(_row_count(result))
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+@asynccontextmanager
+async def observe_upstream(upstream: str, method: str):
+    in_flight = UPSTREAMS_IN_FLIGHT.labels(upstream)
+    in_flight.inc()
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        UPSTREAM_ERRORS.labels(upstream, method).inc()
+        raise
+    finally:
+        UPSTREAM_LATENCY.labels(upstream, method).observe(time.perf_counter() - start)
+        in_flight.dec()
+
+
+async def metrics_middleware(request: Request, call_next):
+    in_flight = REQUESTS_IN_FLIGHT.labels(request.method)
+    in_flight.inc()
+    start = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        route = request.scope.get('route')
+        REQUEST_LATENCY.labels(request.method, route.path if route else 'unmatched',
+                               status_code).observe(time.perf_counter() - start)
+        in_flight.dec()
+
+
+def render_metrics() -> Response:
+    # Under gunicorn with PROMETHEUS_MULTIPROC_DIR set, aggregate the samples of every worker
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(content=generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
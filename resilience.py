@@ -0,0 +1,249 @@
+import asyncio
+import contextvars
+import logging
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from functools import wraps
+
+from fastapi import Request
+
+from admission import Overloaded
+from metrics import BREAKER_STATE
+
+logger = logging.getLogger('resilience')
+
+# Seconds a single call to the dependency may take; override with timeout_<name>
+DEFAULT_TIMEOUTS = {
+    'app': 5,
+    'BGBilling': 8,
+    'Felix': 8,
+    'alfa': 15,
+    'onesignal': 10,
+    'zabbix': 20,
+    'billing-2': 15,
+}
+REQUEST_DEADLINE = float(os.getenv('request_deadline_seconds', '20'))
+STALE_CACHE_SIZE = 10000
+
+# Absolute (monotonic) deadline of the API request being served, None outside requests
+_deadline = contextvars.ContextVar('request_deadline', default=None)
+
+_STATE_VALUES = {'closed': 0, 'half-open': 1, 'open': 2}
+
+
+class CircuitOpen(Exception):
+    def __init__(self, dependency: str, retry_after: int):
+        super().__init__(f'{dependency} circuit is open')
+        self.dependency = dependency
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, dependency: str):
+        super().__init__(f'{dependency} did not answer in time')
+        self.dependency = dependency
+
+
+class CircuitBreaker:
+    # closed -> open when the error rate over `window` seconds reaches `error_rate` (after `min_calls`),
+    # open -> half-open after `open_seconds`, half-open lets one trial call through to decide
+    def __init__(self, name: str, window: float = 30, min_calls: int = 10, error_rate: float = 0.5,
+                 open_seconds: float = 15):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.open_seconds = open_seconds
+        self.state = 'closed'
+        self.opened_at = 0.0
+        self.trial_started = None
+        self._results = deque()
+        self._failures = 0
+        self._gauge = BREAKER_STATE.labels(name)
+        self._gauge.set(0)
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            logger.warning('circuit %s: %s -> %s', self.name, self.state, state)
+        self.state = state
+        self._gauge.set(_STATE_VALUES[state])
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.open_seconds - (time.monotonic() - self.opened_at)))
+
+    def allow(self) -> bool:
+        now = time.monotonic()
+        if self.state == 'open':
+            if now - self.opened_at < self.open_seconds:
+                return False
+            self._set_state('half-open')
+            self.trial_started = None
+        if self.state == 'half-open':
+            if self.trial_started is not None and now - self.trial_started < self.open_seconds:
+                return False
+            self.trial_started = now
+        return True
+
+    def record(self, ok: bool):
+        now = time.monotonic()
+        if self.state == 'half-open':
+            self.trial_started = None
+            if ok:
+                self._results.clear()
+                self._failures = 0
+                self._set_state('closed')
+            else:
+                self._open(now)
+            return
+        self._results.append((now, ok))
+        if not ok:
+            self._failures += 1
+        while self._results and now - self._results[0][0] > self.window:
+            _, old_ok = self._results.popleft()
+            if not old_ok:
+                self._failures -= 1
+        if len(self._results) >= self.min_calls and self._failures / len(self._results) >= self.error_rate:
+            self._open(now)
+
+    def _open(self, now: float):
+        self.opened_at = now
+        self._results.clear()
+        self._failures = 0
+        self._set_state('open')
+
+
+breakers = {name: CircuitBreaker(name) for name in DEFAULT_TIMEOUTS}
+
+
+def remaining() -> float | None:
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def _record_failure(breaker: CircuitBreaker, error: Exception) -> None:
+    # An error counts against the innermost dependency it came through: a helper of another dependency nested
+    # in this call (an app DB helper looking up billing) has recorded it already, and this one must not
+    if getattr(error, 'failed_dependency', None) is not None:
+        return
+    breaker.record(False)
+    try:
+        error.failed_dependency = breaker.name
+    except AttributeError:
+        pass
+
+
+def dependency_timeout(dependency: str) -> float:
+    return float(os.getenv(f"timeout_{dependency.lower().replace('-', '_')}", DEFAULT_TIMEOUTS[dependency]))
+
+
+def deadline_bound(dependency: str) -> bool:
+    # Whether the request's deadline, not the dependency's own timeout, limits a call starting now. A timeout
+    # then only says the client asked for less time (X-Request-Timeout): not a failure of the dependency.
+    left = remaining()
+    return left is not None and left < dependency_timeout(dependency)
+
+
+def timeout_for(dependency: str) -> float:
+    # Per-dependency timeout, shortened to what is left of the current request's deadline
+    timeout = dependency_timeout(dependency)
+    left = remaining()
+    if left is not None:
+        if left <= 0:
+            raise DeadlineExceeded(dependency)
+        timeout = min(timeout, left)
+    return timeout
+
+
+def client_session(dependency: str):
+    # aiohttp session whose calls are bounded by timeout_for(dependency). aiohttp is imported on first use so
+    # API processes that never call out (and the import-time budget, bench/imports.py) don't pay for it.
+    import aiohttp
+
+    return aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout_for(dependency)))
+
+
+@asynccontextmanager
+async def guard(dependency: str):
+    # Circuit breaker around an outbound call; the call itself carries timeout_for(dependency)
+    breaker = breakers[dependency]
+    if not breaker.allow():
+        raise CircuitOpen(dependency, breaker.retry_after())
+    bound = deadline_bound(dependency)
+    try:
+        yield
+    except (CircuitOpen, DeadlineExceeded, Overloaded):
+        raise
+    except asyncio.TimeoutError:
+        if not bound:
+            breaker.record(False)
+        raise DeadlineExceeded(dependency)
+    except Exception as e:
+        _record_failure(breaker, e)
+        raise
+    breaker.record(True)
+
+
+def resilient(dependency: str, stale: bool = False):
+    # Decorator for db helpers, placed below @limited so the timeout starts once the call holds its slot: time
+    # spent queueing is our load, not the dependency's. Circuit breaker and timeout; with stale=True the last
+    # good answer for the same arguments is served while the dependency is failing.
+    breaker = breakers[dependency]
+
+    def decorator(func):
+        cache = OrderedDict()
+
+        def fallback(key, error: Exception):
+            if stale and key in cache:
+                logger.warning('%s: serving stale %s after %r', dependency, func.__name__, error)
+                return cache[key]
+            raise error
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items()))) if stale else None
+            if not breaker.allow():
+                return fallback(key, CircuitOpen(dependency, breaker.retry_after()))
+            bound = deadline_bound(dependency)
+            try:
+                timeout = timeout_for(dependency)
+                result = await asyncio.wait_for(func(*args, **kwargs), timeout)
+            except asyncio.TimeoutError:
+                if not bound:
+                    breaker.record(False)
+                return fallback(key, DeadlineExceeded(dependency))
+            except (CircuitOpen, DeadlineExceeded, Overloaded) as e:
+                # Raised by nested helpers' breakers and admission control, not a failure of this call
+                return fallback(key, e)
+            except Exception as e:
+                _record_failure(breaker, e)
+                return fallback(key, e)
+            breaker.record(True)
+            if stale:
+                cache[key] = result
+                cache.move_to_end(key)
+                if len(cache) > STALE_CACHE_SIZE:
+                    cache.popitem(last=False)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+async def deadline_middleware(request: Request, call_next):
+    # Every request gets a deadline; clients may ask for a shorter one with X-Request-Timeout (seconds)
+    budget = REQUEST_DEADLINE
+    requested = request.headers.get('x-request-timeout')
+    if requested:
+        try:
+            budget = min(budget, max(float(requested), 0.0))
+        except ValueError:
+            pass
+    token = _deadline.set(time.monotonic() + budget)
+    try:
+        return await call_next(request)
+    finally:
+        _deadline.reset(token)
@@ -1,4 +1,4 @@
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 from pydantic import BaseModel
 
@@ -127,10 +127,34 @@ class MessagesList(BaseModel):
     messages: List[Message]
 
 
+class FoundMessage(Message):
+    room_id: str
+
+
+class SearchResults(BaseModel):
+    messages: List[FoundMessage]
+    next_less_id: Optional[int] = None
+
+
 class Room(BaseModel):
     name: str
     latest_message: Message
+    unread: int = 0
+    awaiting_reply: bool = False
+    requires_action: bool = False
+    accident: bool = False
 
 
 class Rooms(BaseModel):
     rooms: List[Room]
+    next_less_id: Optional[int] = None
+
+
+class Bootstrap(BaseModel):
+    # Everything the app loads on launch; a section that failed is null and its reason is in errors
+    me: Optional[UserData] = None
+    autopay: Optional[AutoPayDetails] = None
+    accident: Optional[Accident] = None
+    news: Optional[News] = None
+    chat: Optional[MessagesList] = None
+    errors: Dict[str, str] = {}
@@ -0,0 +1,72 @@
+import asyncio
+import contextvars
+import inspect
+from functools import wraps
+
+from metrics import SINGLEFLIGHT_CALLS
+from resilience import _deadline
+
+# Identical concurrent calls share one execution: a caller whose key is already in flight awaits that call
+# instead of issuing its own. The call runs as a task of its own, so a caller that gives up (cancelled,
+# bootstrap section timeout) doesn't cancel it for the rest.
+#
+# (function, key) -> (task, first argument as str); an entry lives only while its call is running
+flights = {}
+
+
+def forget(subject) -> None:
+    # After a write about `subject` (an account or room, the helpers' first argument): later reads start a
+    # call of their own instead of joining one that may have started before the write
+    subject = str(subject)
+    for flight_key in [flight_key for flight_key, (_, first) in flights.items() if first == subject]:
+        del flights[flight_key]
+
+
+def _call_context() -> contextvars.Context:
+    # The shared call keeps the first caller's context (its request id for the logs, and the admission slots it
+    # holds, so a nested helper doesn't queue for a second slot of the same dependency) but not its request
+    # deadline: the call serves callers with deadlines of their own
+    context = contextvars.copy_context()
+    context.run(_deadline.set, None)
+    return context
+
+
+def single_flight(key=None):
+    # Decorator for read helpers, placed above @limited. `key(*args, **kwargs)` builds the flight key when
+    # the arguments aren't hashable as they are; calls whose key isn't hashable just run.
+    def decorator(func):
+        name = f'{func.__module__}.{func.__qualname__}'
+        first_parameter = next(iter(inspect.signature(func).parameters), None)
+        executed = SINGLEFLIGHT_CALLS.labels(func.__name__, 'executed')
+        coalesced = SINGLEFLIGHT_CALLS.labels(func.__name__, 'coalesced')
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            flight_key = (name, key(*args, **kwargs) if key else (args, tuple(sorted(kwargs.items()))))
+            try:
+                flight = flights.get(flight_key)
+            except TypeError:
+                executed.inc()
+                return await func(*args, **kwargs)
+            if flight is None:
+                task = asyncio.get_running_loop().create_task(func(*args, **kwargs), context=_call_context())
+                subject = args[0] if args else kwargs.get(first_parameter)
+                flights[flight_key] = (task, None if subject is None else str(subject))
+
+                def done(_):
+                    if flights.get(flight_key, (None,))[0] is task:
+                        del flights[flight_key]
+                    # Mark the outcome retrieved even if every caller gave up waiting
+                    if not task.cancelled():
+                        task.exception()
+
+                task.add_done_callback(done)
+                executed.inc()
+            else:
+                task = flight[0]
+                coalesced.inc()
+            return await asyncio.shield(task)
+
+        return wrapper
+
+    return decorator
@@ -2,50 +2,109 @@ import asyncio
 import calendar
 import datetime
 import json
+import logging
 import os
 import time
-from pprint import pprint
-
-import aiohttp
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
 
 from acquiring import get_status_payment, pay_request, autopay_request
-from db.app_db import (set_autopay, get_accounts, set_accident_status, get_autopay_users, news_exist, _when_to_pay,
-                       get_accident_status, upsert_news)
-from db.billing_db import update_user_balance_old, get_user_group_ids, get_user_location, get_group_id
+from db.app_db import (set_autopay, get_accounts, set_accident_status, get_autopay_users, news_exist,
+                       upsert_news, get_open_payment_orders, transition_payment_order, get_idle_rooms,
+                       archive_rooms, add_payment_order, get_unnotified_alerts, mark_alerts_notified,
+                       PAYMENT_ORDER_TTL, get_calendar_accounts, get_stale_pay_days, save_pay_days,
+                       get_accounts_paying_on, penultimate_date_of_current_month)
+from db.billing_db import update_user_balance_old, mark_written, get_user_group_ids, get_user_location, \
+    get_group_id, get_pay_days_old
+from admission import Overloaded, admit, limiters
+from metrics import observe_upstream
+from resilience import CircuitOpen, DeadlineExceeded, client_session, guard
+from singleflight import single_flight
 from dotenv import load_dotenv
 
 load_dotenv()
 
-
-async def check_payment_status(order_id: str, user_id=None, autopay=False) -> None:
-    while True:
-        json_status = await get_status_payment(order_id)
-        status = json.loads(json_status)
-        if status.get('OrderStatus'):
-            if status['OrderStatus'] == 2:
-                # print('Проведена полная авторизация суммы заказа')
+logger = logging.getLogger('tasks')
+
+PUSH_URL = os.getenv('push_api_url', 'https://onesignal.com/api/v1/notifications')
+ZABBIX_URL = os.getenv('zabbix_api_url', 'https://zabbix2.vt54.ru/zabbix/api_jsonrpc.php')
+BILLING2_PAY_URL = os.getenv('billing2_pay_url', 'https://billing-2.vt54.ru/alfa-pay/1')
+CHAT_ARCHIVE_AFTER_MONTHS = int(os.getenv('chat_archive_after_months', '6'))
+CHAT_ARCHIVE_BATCH = 100  # rooms moved per transaction
+PAY_DAYS_MAX_AGE_HOURS = int(os.getenv('pay_days_max_age_hours', '24'))
+PAY_DAYS_REFRESH_BATCH = int(os.getenv('pay_days_refresh_batch', '5000'))
+PAY_DAYS_BILLING_CHUNK = 500  # accounts per billing query
+# Orders reconciled at a time: each asks Alfa-Bank for its status, so a backlog stays within alfa's admission limit
+RECONCILE_BATCH = limiters['alfa'].limit
+# Reminders sent at a time: OneSignal's admission limit, so a page never queues behind itself
+PUSH_BATCH = limiters['onesignal'].limit
+
+
+async def reconcile_payment(order_id: str, user_id=None, autopay=False, state='pending') -> str | None:
+    # One status check of a registered order; returns the state it was moved to, None while it stays where it is
+    json_status = await get_status_payment(order_id)
+    status = json.loads(json_status)
+    if status.get('OrderStatus'):
+        if status['OrderStatus'] == 2:
+            # print('Проведена полная авторизация суммы заказа')
+            # Claim the order before crediting so no other run takes it. An order already in crediting had its
+            # credit fail; both billings credit once per order (deposit ext_id, txn_id), so it is simply retried.
+            if state == 'pending' and not await transition_payment_order(order_id, 'pending', 'crediting'):
+                return None
+            try:
                 payment_summ = int(status['Amount']) / 100
                 if autopay:
                     await set_autopay(user_id, status['bindingId'], payment_summ, status['Ip'])
                 txn_date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                update_balance_url = (f'https://billing-2.vt54.ru/alfa-pay/1?command=pay&txn_id={order_id}&'
+                update_balance_url = (f'{BILLING2_PAY_URL}?command=pay&txn_id={order_id}&'
                                       f'txn_date={txn_date}&sum={float(payment_summ)}&account={user_id}')
                 match len(user_id):
                     case 4:
                         await update_user_balance_old(user_id, payment_summ, order_id)
                     case 5:
-                        async with aiohttp.ClientSession() as session:
-                            await session.get(update_balance_url)
-                            # print(await response.text())
-                break
-            elif status['OrderStatus'] in [3, 6]:
-                # print('Авторизация отклонена')
-                break
-            else:
-                # print(json.loads(status)['OrderStatus'])
-                await asyncio.sleep(5)
+                        async with client_session('billing-2') as session:
+                            async with guard('billing-2'), admit('billing-2'), observe_upstream('billing-2', 'pay'):
+                                async with session.get(update_balance_url) as response:
+                                    body = await response.text()
+                                if response.status >= 400:
+                                    raise RuntimeError(f'billing-2 answered {response.status}: {body[:200]}')
+                        await mark_written(user_id)
+            except Exception as e:
+                logger.error('order %s of %s: crediting failed, left in state crediting to retry: %r',
+                             order_id, user_id, e)
+                raise
+            await transition_payment_order(order_id, 'crediting', 'done')
+            return 'done'
+        elif status['OrderStatus'] in [3, 6]:
+            # print('Авторизация отклонена')
+            await transition_payment_order(order_id, 'pending', 'declined')
+            return 'declined'
+    # print(json.loads(status)['OrderStatus'])
+    return None
+
+
+async def reconcile_payments():
+    # Check every open order once: pending ones registered by the API and paid ones whose credit failed. Give up
+    # on pending orders the bank has expired.
+    orders = await get_open_payment_orders()
+    now = time.time()
+
+    async def reconcile(order_id, user_id, autopay, created_at, state):
+        if await reconcile_payment(order_id, user_id, autopay=bool(autopay), state=state) is None \
+                and state == 'pending' and now - created_at > PAYMENT_ORDER_TTL:
+            await transition_payment_order(order_id, 'pending', 'expired')
+
+    for start in range(0, len(orders), RECONCILE_BATCH):
+        batch = orders[start:start + RECONCILE_BATCH]
+        results = await asyncio.gather(*[reconcile(*order) for order in batch], return_exceptions=True)
+        for (order_id, user_id, *_), result in zip(batch, results):
+            if isinstance(result, Exception):
+                logger.error('reconciling order %s of %s failed: %r', order_id, user_id, result)
+
+
+async def archive_chats():
+    # Move rooms without messages for CHAT_ARCHIVE_AFTER_MONTHS to messages_archive, a batch at a time
+    idle_since = int(time.time()) - CHAT_ARCHIVE_AFTER_MONTHS * 30 * 86400
+    while rooms := await get_idle_rooms(idle_since, CHAT_ARCHIVE_BATCH):
+        await archive_rooms(rooms)
 
 
 async def init_autopay():
@@ -60,11 +119,13 @@ async def init_autopay():
             payment_amount = user[3]
             ip = user[4]
             pay_response = await pay_request(amount_rubles=payment_amount, auto_payment=True, client_id=user_id)
+            # Credited by reconcile_payments like the orders the API registers
+            await add_payment_order(pay_response['orderId'], user_id, autopay=True)
             await autopay_request(pay_response['orderId'], binding_id, ip)
-            await check_payment_status(pay_response['orderId'], user_id, autopay=True)
 
 
-async def push(message, account, accident=False):
+async def push(message, account) -> bool:
+    # True once OneSignal accepted the notification; failures are logged and reported as False, never raised
     headers = {
         'Authorization': f'Basic {os.getenv("push_api_key")}',
         'accept': 'application/json',
@@ -83,19 +144,32 @@ async def push(message, account, accident=False):
 
     json_data = json.dumps(data)
 
-    async with aiohttp.ClientSession() as session:
-        if accident:
-            current_accident_status = await get_accident_status(account)
-            if not current_accident_status:
-                async with session.post('https://onesignal.com/api/v1/notifications',
+    try:
+        async with client_session('onesignal') as session:
+            async with guard('onesignal'), admit('onesignal'), observe_upstream('onesignal', 'notifications'):
+                async with session.post(PUSH_URL,
                                         headers=headers,
                                         data=json_data) as response:
-                    await response.text()
-        else:
-            async with session.post('https://onesignal.com/api/v1/notifications',
-                                    headers=headers,
-                                    data=json_data) as response:
-                await response.text()
+                    body = await response.text()
+    except (CircuitOpen, Overloaded, DeadlineExceeded) as e:
+        # Push provider down or its queue full: report it undelivered instead of piling up retries
+        logger.warning('push to %s dropped: %s', account, e)
+        return False
+    except Exception as e:
+        logger.warning('push to %s failed: %r', account, e)
+        return False
+    if response.status >= 400:
+        logger.warning('push to %s rejected with %s: %s', account, response.status, body[:200])
+        return False
+    return True
+
+
+@single_flight(key=lambda data: json.dumps(data, sort_keys=True))
+async def zabbix_request(data: dict) -> dict:
+    async with client_session('zabbix') as session:
+        async with guard('zabbix'), admit('zabbix'), observe_upstream('zabbix', data['method']):
+            async with session.get(ZABBIX_URL, json=data) as response:
+                return await response.json()
 
 
 async def check_alerts():
@@ -104,7 +178,6 @@ async def check_alerts():
     # print(accounts)
     groups = await get_user_group_ids(accounts)
     # print(groups)
-    url = 'https://zabbix2.vt54.ru/zabbix/api_jsonrpc.php'
     host_group_data = {
         "jsonrpc": "2.0",
         "method": "hostgroup.get",
@@ -118,15 +191,9 @@ async def check_alerts():
         "id": 2
     }
 
-    async def zabbix_request(url, data):
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, json=data) as response:
-                response_json = await response.json()
-                return response_json
-
     # pprint(host_group_data)
 
-    group_id_response = await zabbix_request(url, host_group_data)
+    group_id_response = await zabbix_request(host_group_data)
     # print(group_id_response)
     try:
         host_groups_ids = [int(item['groupid']) for item in group_id_response['result'] if group_id_response['result']]
@@ -144,7 +211,7 @@ async def check_alerts():
         }
 
         # pprint(status_data)
-        status_response = await zabbix_request(url, status_data)
+        status_response = await zabbix_request(status_data)
         # pprint(status_response)
 
         host_ids = [host['hostid'] for host in status_response['result'] if status_response['result']]
@@ -161,7 +228,7 @@ async def check_alerts():
             "id": 1
         }
 
-        dev_status_response = await zabbix_request(url, dev_status)
+        dev_status_response = await zabbix_request(dev_status)
         # pprint(dev_status_response)
 
         affected_hostids = [host['hostid'] for host in dev_status_response['result']
@@ -183,18 +250,26 @@ async def check_alerts():
         # print('Accounts to notify: ', accounts_to_notify)
         # accounts_to_notify = ["0000"]
 
+        await set_accident_status(accounts_to_notify)
+
+        alert_message = "На линии авария, но мы уже над этим работаем !"
         if accounts_to_notify:
             # setting alert news message to affected acoounts
-            alert_message = "На линии авария, но мы уже над этим работаем !"
-            await asyncio.gather(*[update_news((location := await get_user_location(account))['location_id'],
+            await asyncio.gather(*[upsert_news((location := await get_user_location(account))['location_id'],
                                                location['location'], alert_message) for account in accounts_to_notify])
-            await asyncio.gather(*[push(alert_message, account, accident=True) for account in accounts_to_notify])
-            await set_accident_status(accounts_to_notify)
+        # Pushes not delivered (provider down, queue full) stay unnotified and are retried on the next run
+        unnotified = await get_unnotified_alerts()
+        delivered = await asyncio.gather(*[push(alert_message, account) for account in unnotified])
+        await mark_alerts_notified([account for account, ok in zip(unnotified, delivered) if ok])
     except KeyError:
         pass
 
 
-async def check_news():
+def _read_news_sheet() -> list:
+    # The Sheets client is only needed here; importing it on first use keeps it out of every process's startup
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
+
     scope = ['https://www.googleapis.com/auth/drive', 'https://www.googleapis.com/auth/drive.file',
              'https://www.googleapis.com/auth/spreadsheets']
 
@@ -203,7 +278,17 @@ async def check_news():
     client = gspread.authorize(creds)
 
     wks = client.open("vt54_news").sheet1
-    all_rows = wks.get_all_values()
+    return wks.get_all_values()
+
+
+@single_flight()
+async def fetch_news_rows() -> list:
+    # gspread blocks, so the sheet is read on a thread and the worker's loop keeps running its other jobs
+    return await asyncio.to_thread(_read_news_sheet)
+
+
+async def check_news():
+    all_rows = await fetch_news_rows()
     for row in all_rows:
         location, group_id, message = row
         if group_id.isdigit():
@@ -225,15 +310,42 @@ async def check_news():
 
 
 
-async def pay_day_push():
+async def refresh_pay_days():
+    # Bring the pay-day calendar up to date: accounts not in it yet plus the PAY_DAYS_REFRESH_BATCH rows
+    # refreshed longest ago (older than PAY_DAYS_MAX_AGE_HOURS). Felix dates come from billing in chunks,
+    # BGBilling subscribers all pay on the penultimate day of the month.
     accounts = await get_accounts()
-    accounts_list = [v for v in accounts.values() for v in v]
-    tomorrow = (datetime.datetime.now().date() + datetime.timedelta(days=1)).strftime('%d.%m.%Y')
-    for account in accounts_list:
-        account_pay_day = await _when_to_pay(account)
-        if tomorrow == account_pay_day:
-            message = f'{account_pay_day} списание абонентской платы по вашему тарифу, не забудьте пополнить баланс !'
-            await push(message, account)
+    known = await get_calendar_accounts()
+    updated_before = datetime.datetime.now() - datetime.timedelta(hours=PAY_DAYS_MAX_AGE_HOURS)
+    stale = await get_stale_pay_days(updated_before, PAY_DAYS_REFRESH_BATCH)
+    to_refresh = [account for backend in accounts.values() for account in backend if account not in known] + stale
+
+    penultimate = penultimate_date_of_current_month().date()
+    pay_days = [(account, penultimate) for account in to_refresh if len(account) == 5]
+    felix_accounts = [account for account in to_refresh if len(account) == 4]
+    for i in range(0, len(felix_accounts), PAY_DAYS_BILLING_CHUNK):
+        chunk = felix_accounts[i:i + PAY_DAYS_BILLING_CHUNK]
+        dates = await get_pay_days_old(chunk)
+        pay_days += [(account, dates.get(account)) for account in chunk]
+    await save_pay_days(pay_days)
+
+
+async def pay_day_push():
+    tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+    message = f'{tomorrow:%d.%m.%Y} списание абонентской платы по вашему тарифу, не забудьте пополнить баланс !'
+    after = ''
+    failed = 0
+    while accounts := await get_accounts_paying_on(tomorrow, after, PUSH_BATCH):
+        # A failed push costs that account its reminder, never the pages after it
+        results = await asyncio.gather(*[push(message, account) for account in accounts], return_exceptions=True)
+        for account, result in zip(accounts, results):
+            if isinstance(result, BaseException):
+                logger.error('pay day push to %s raised', account, exc_info=result)
+            if result is not True:
+                failed += 1
+        after = accounts[-1]
+    if failed:
+        logger.warning('pay day push: %s reminders for %s not delivered', failed, tomorrow)
 
 
 async def check_news_alerts():
@@ -0,0 +1,59 @@
+import asyncio
+import datetime
+import logging
+import os
+import signal
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+from db.app_db import storage
+from db.migrations import migrate
+from leader import campaign, leader_only, resign, CAMPAIGN_INTERVAL
+from logs import setup_logging
+from tasks import init_autopay, check_news_alerts, pay_day_push, reconcile_payments, archive_chats, \
+    refresh_pay_days
+
+# Background worker: owns the scheduled jobs and payment reconciliation so the API event loop only
+# serves requests. Run any number of replicas with `python -m worker`; the leader lock makes exactly
+# one of them execute the jobs and the rest take over if it dies.
+
+
+async def start(scheduler: AsyncIOScheduler) -> None:
+    await campaign()
+    # Every replica campaigns for leadership; only the leader runs the jobs below
+    scheduler.add_job(campaign, trigger='interval', seconds=CAMPAIGN_INTERVAL, max_instances=1)
+    scheduler.add_job(leader_only(reconcile_payments), trigger='interval', seconds=5, max_instances=1)
+    scheduler.add_job(leader_only(refresh_pay_days), trigger='interval', hours=1, max_instances=1,
+                      next_run_time=datetime.datetime.now() + datetime.timedelta(seconds=30))
+    scheduler.add_job(leader_only(pay_day_push), trigger='cron', hour=10, minute=0, max_instances=1)
+    scheduler.add_job(leader_only(check_news_alerts), trigger='interval', minutes=5, max_instances=1)
+    scheduler.add_job(leader_only(archive_chats), trigger='cron', hour=3, minute=30, max_instances=1)
+    scheduler.add_job(leader_only(init_autopay), trigger='interval', days=1, max_instances=1,
+                      next_run_time=datetime.datetime.now() + datetime.timedelta(seconds=60))
+
+
+async def stop() -> None:
+    await resign()
+
+
+async def main():
+    setup_logging()
+    await migrate()
+    scheduler = AsyncIOScheduler()
+    scheduler.start()
+    await start(scheduler)
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+    logging.getLogger('worker').info('worker %s started', os.getpid())
+    await stopping.wait()
+
+    scheduler.shutdown()
+    await stop()
+    await storage.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())